@@ -0,0 +1,56 @@
+#!/usr/bin/python
+
+import argparse
+import time
+
+from shared import *
+from calc_corpus_metrics import *
+
+
+def time_separate_metrics(words, line_starts, token_count, seed):
+    start = time.time()
+    word_counts = sample_words_counts(words, token_count, np.random.RandomState(seed))
+    res = {
+        LEXICAL_RICHNESS: calc_lexical_richness(words, line_starts, token_count, word_counts=word_counts),
+        COLLOCATIONS: calc_collocations(words, line_starts, token_count, np.random.RandomState(seed)),
+        COHESIVE_MARKERS_METRIC: calc_cohesive_markers(words, line_starts, token_count, np.random.RandomState(seed)),
+        PERSONAL_PRONOUNS: calc_personal_pronouns(words, line_starts, token_count, word_counts=word_counts)
+    }
+    return res, time.time() - start
+
+
+def time_fused_metrics(words, line_starts, token_count, seed):
+    start = time.time()
+    res = calc_metrics_fused(words, line_starts, token_count, np.random.RandomState(seed))
+    return res, time.time() - start
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("-d","--debug",action='store_true')
+    p.add_argument("-j","--lines-json-location",default="/tmp/")
+    p.add_argument("--lines-format",choices=LINES_FORMATS,default=LINES_FORMAT_JSON)
+    p.add_argument("--seed",type=int,default=0, help="Both engines sample the words and lines with this seed")
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    set_logging(args.debug)
+
+    words, line_starts = lines_dict_to_words_and_line_starts(load_lines(args.lines_json_location, args.lines_format))
+    token_count = min([len(l) for l in words.values()])
+    logging.info("Token amount for metric calculations = %d", token_count)
+    # Build the matchers up front so neither timing pays for them
+    get_idioms_automaton()
+    get_cohesive_markers_trie()
+
+    separate_res, separate_time = time_separate_metrics(words, line_starts, token_count, args.seed)
+    fused_res, fused_time = time_fused_metrics(words, line_starts, token_count, args.seed)
+
+    logging.info("Checking both engines agree")
+    assert separate_res == fused_res, "{} not {}".format(str(fused_res), str(separate_res))
+    logging.info("All Good!")
+    logging.info("Separate metrics: %f seconds", separate_time)
+    logging.info("Fused metrics: %f seconds", fused_time)
+    logging.info("Speedup = %fx", separate_time / fused_time)
@@ -0,0 +1,58 @@
+#!/usr/bin/python
+
+import argparse
+import itertools
+import timeit
+
+from shared import *
+from corpus_to_files import separate_identification, separate_identification_etree
+
+
+SAMPLE_ID_LINES = [
+    '<SPEAKER COUNT="1" NAME="Mr. Bill Blaikie" LANGUAGE="EN" />',
+    '<SPEAKER COUNT="2" NAME="Mrs. Suzanne Tremblay" LANGUAGE="FR" />',
+    '<SPEAKER COUNT="3" NAME="Hon. Jim Peterson" LANGUAGE="EN" />',
+    '<SPEAKER COUNT="4" NAME="The Chair &amp; Co" LANGUAGE="EN" />',
+]
+
+
+def load_id_lines(file_pattern, line_amount):
+    filename = file_pattern + ID_SUFFIX
+    logging.info("Loading %d ID lines from %s", line_amount, filename)
+    with open(filename) as f:
+        return [l.rstrip("\r\n") for l in itertools.islice(f, line_amount)]
+
+
+def time_parser(parser, id_lines, repeat):
+    timer = timeit.Timer(lambda: [parser(l) for l in id_lines])
+    return min(timer.repeat(repeat=repeat, number=1))
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("-d","--debug",action='store_true')
+    p.add_argument("-p","--file-pattern", help="The base file name pattern where the %s file is, uses sample lines if omitted"%ID_SUFFIX)
+    p.add_argument("-n","--line-amount",type=int,default=1000000)
+    p.add_argument("-r","--repeat",type=int,default=3)
+    return p.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    set_logging(args.debug)
+
+    if args.file_pattern:
+        id_lines = load_id_lines(args.file_pattern, args.line_amount)
+    else:
+        id_lines = list(itertools.islice(itertools.cycle(SAMPLE_ID_LINES), args.line_amount))
+
+    logging.info("Checking both parsers agree on %d lines", len(id_lines))
+    for l in id_lines:
+        assert separate_identification(l) == separate_identification_etree(l), l
+    logging.info("All Good!")
+
+    etree_time = time_parser(separate_identification_etree, id_lines, args.repeat)
+    logging.info("ElementTree parser: %f seconds (%f lines/sec)", etree_time, len(id_lines) / etree_time)
+    fast_time = time_parser(separate_identification, id_lines, args.repeat)
+    logging.info("Fast parser: %f seconds (%f lines/sec)", fast_time, len(id_lines) / fast_time)
+    logging.info("Speedup = %fx", etree_time / fast_time)
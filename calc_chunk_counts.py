@@ -3,25 +3,33 @@
 import argparse
 from random import shuffle
 from collections import Counter
+from multiprocessing import Pool
 import itertools
 import nltk
+import scipy.sparse
 
 from shared import *
 from en_function_words import FUNCTION_WORDS
 
 
-def lines_to_word_chunks(class_lines, chunk_size, to_shuffle=False):
+TRIGRAM_ID_BITS = 21
+CHUNK_BATCH_SIZE = 1000
+POOL_WINDOW_TASKS = 4
+
+
+def iter_word_chunks(class_lines, chunk_size):
     curr_chunk = []
-    chunks = []
-    if to_shuffle:
-        shuffle(class_lines)
     for l in class_lines:
-        split_line = l.split()
-        curr_chunk.extend(split_line)
+        curr_chunk.extend(l.split())
         if len(curr_chunk) >= chunk_size:
-            chunks.append(curr_chunk)
+            yield curr_chunk
             curr_chunk = []
-    return chunks
+
+
+def lines_to_word_chunks(class_lines, chunk_size, to_shuffle=False):
+    if to_shuffle:
+        shuffle(class_lines)
+    return list(iter_word_chunks(class_lines, chunk_size))
 
 
 # freq list of a chunk
@@ -48,6 +56,85 @@ def get_func_word_counts(words):
     return fw_words_counts
 
 
+def encoded_lines_to_chunk_bounds(encoded_lines, chunk_size):
+    # Same chunks as lines_to_word_chunks, as [start, end) token offsets
+    bounds = []
+    start = 0
+    for end in encoded_lines.line_starts[1:].tolist():
+        if end - start >= chunk_size:
+            bounds.append((start, end))
+            start = end
+    return np.array(bounds, dtype=np.int64).reshape(-1, 2)
+
+
+def count_columns_by_chunk(columns, chunk_bounds, column_amount):
+    # columns[i] is the count column of the token at chunk_bounds[0][0] + i, -1 when not counted
+    chunk_amount = len(chunk_bounds)
+    if chunk_amount == 0:
+        return np.zeros((0, column_amount), dtype=np.int64)
+    chunk_ids = np.repeat(np.arange(chunk_amount, dtype=np.int64), chunk_bounds[:, 1] - chunk_bounds[:, 0])
+    counted = columns >= 0
+    flat = chunk_ids[counted] * column_amount + columns[counted]
+    return np.bincount(flat, minlength=chunk_amount * column_amount).reshape(chunk_amount, column_amount)
+
+
+def func_word_vocab_columns(vocab):
+    # Function-word column of every vocabulary ID, -1 for the other words
+    word_ids = {w: i for i, w in enumerate(vocab)}
+    vocab_columns = np.full(len(vocab), -1, dtype=np.int64)
+    for column, fw in enumerate(FUNCTION_WORDS):
+        if fw in word_ids:
+            vocab_columns[word_ids[fw]] = column
+    return vocab_columns
+
+
+def get_func_word_counts_matrix(tokens, chunk_bounds, vocab_columns):
+    chunk_tokens = tokens[chunk_bounds[0][0]:chunk_bounds[-1][1]] if len(chunk_bounds) else tokens[:0]
+    return count_columns_by_chunk(vocab_columns[chunk_tokens], chunk_bounds, len(FUNCTION_WORDS))
+
+
+def pack_trigrams(tokens):
+    # Packs the trigram starting at every position into one uint64 key, 21 bits per token ID
+    tokens = np.asarray(tokens).astype(np.uint64)
+    if len(tokens) < 3:
+        return np.zeros(0, dtype=np.uint64)
+    assert tokens.max() < (1 << TRIGRAM_ID_BITS), "Vocabulary too large for packed trigrams"
+    return (tokens[:-2] << np.uint64(2 * TRIGRAM_ID_BITS)) | (tokens[1:-1] << np.uint64(TRIGRAM_ID_BITS)) | tokens[2:]
+
+
+def unpack_trigram(key):
+    mask = (1 << TRIGRAM_ID_BITS) - 1
+    key = int(key)
+    return key >> (2 * TRIGRAM_ID_BITS), (key >> TRIGRAM_ID_BITS) & mask, key & mask
+
+
+def packed_most_common_trigrams(tokens, top=3000):
+    logging.info("Calculating %d most common POS Trigrams in corpus", top)
+    keys, counts = np.unique(pack_trigrams(tokens), return_counts=True)
+    # Most common first, ties broken by key so the vocabulary is deterministic
+    return keys[np.lexsort((keys, -counts))[:top]]
+
+
+def get_packed_trigram_counts_matrix(tokens, chunk_bounds, trigram_keys):
+    if len(chunk_bounds) == 0:
+        return np.zeros((0, len(trigram_keys)), dtype=np.int64)
+    first, last = chunk_bounds[0][0], chunk_bounds[-1][1]
+    keys = pack_trigrams(tokens[first:last])
+    # Only trigrams that end inside the chunk they start in are counted
+    chunk_ends = np.repeat(chunk_bounds[:, 1], chunk_bounds[:, 1] - chunk_bounds[:, 0])[:len(keys)]
+    inside = np.arange(first, first + len(keys)) + 2 < chunk_ends
+    order = np.argsort(trigram_keys)
+    sorted_keys = trigram_keys[order]
+    found = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    columns = np.full(last - first, -1, dtype=np.int64)
+    columns[:len(keys)] = np.where(inside & (sorted_keys[found] == keys), order[found], -1)
+    return count_columns_by_chunk(columns, chunk_bounds, len(trigram_keys))
+
+
+def get_chunks_counts_matrix(tokens, chunk_bounds, counters):
+    return np.hstack([c[0](tokens, chunk_bounds, *c[1:]) for c in counters])
+
+
 def words_to_most_common_pos_trigrams(words, top=3000):
     logging.info("Calculating %d most common POS Trigrams in corpus", top)
     c = Counter(nltk.trigrams(words))
@@ -58,24 +145,37 @@ def parse_args():
     p = argparse.ArgumentParser()
     p.add_argument("-d","--debug",action='store_true')
     p.add_argument("-j","--lines-json-location",default="/tmp/")
+    p.add_argument("--lines-format",choices=LINES_FORMATS,default=LINES_FORMAT_JSON)
     p.add_argument("--output-location",default="/tmp/")
     p.add_argument("--function-word-counts",action='store_true')
     p.add_argument("--pos-counts",action='store_true')
     p.add_argument("-c","--chunk-size",type=int,default=1000)
+    p.add_argument("--counts-format",choices=COUNTS_FORMATS,default=COUNTS_FORMAT_JSON)
+    p.add_argument("--npy-dtype",choices=["uint16", "float32"],default="float32", help="Type of the npy counts matrix")
+    p.add_argument("--jobs",type=int,default=1, help="Amount of processes counting chunks")
+    p.add_argument("--per-chunk-counting",action='store_true', help="Count each chunk's words with Counters instead of the vectorized counters")
     return p.parse_args()
 
 
-if __name__ == '__main__':
-    args = parse_args()
-    set_logging(args.debug)
+def imap_windows(pool, func, items, window_size, chunksize=1):
+    # pool.imap's feeder thread would take all the items at once, so only window_size of them are handed over at a time
+    items = iter(items)
+    while True:
+        window = list(itertools.islice(items, window_size))
+        if not window:
+            break
+        for res in pool.imap(func, window, chunksize):
+            yield res
+
 
-    lines = load_lines_json(args.lines_json_location)
+def count_chunks_per_chunk(args):
+    lines = load_lines(args.lines_json_location, args.lines_format)
 
     counters = []
     if args.pos_counts:
-        words = lines_dict_to_words_dict(lines)
         logging.info("Generating POS counts from words")
-        pos_trigrams = words_to_most_common_pos_trigrams(itertools.chain.from_iterable(words.values()))
+        pos_trigrams = words_to_most_common_pos_trigrams(
+            itertools.chain.from_iterable(l.split() for class_lines in lines.values() for l in class_lines))
         logging.debug(pos_trigrams)
         counters.append([get_pos_trigram_counts, pos_trigrams])
 
@@ -84,13 +184,198 @@ if __name__ == '__main__':
 
     assert len(counters) > 0, "No counter selected for chunks, see help for flags"
 
-    for key in [EN_LINES_KEY, EN_NON_NATIVE_LINES_KEY, FR_LINES_KEY]:
-        logging.info("Generating " + key + " chunks of size=" + str(args.chunk_size))
-        chunks = lines_to_word_chunks(lines[key], args.chunk_size)
-        logging.info("Analyzing chunks")
-        chunks_counts = [get_chunk_counts(chunk, counters) for chunk in chunks]
-        filename = args.output_location + CHUNK_FILENAME_PREFIX.format(key,str(args.chunk_size)) + COUNTS_SUFFIX
-        logging.info("Writing chunks' counts to %s", filename)
-        with open(filename, 'w') as f:
-            json.dump(chunks_counts, f)
-        logging.info("Done writing chunks' counts to %s", filename)
+    pool = Pool(args.jobs, initializer=set_chunk_counting_state, initargs=({"counters": counters},)) \
+        if args.jobs > 1 else None
+    set_chunk_counting_state({"counters": counters})
+    try:
+        for key in [EN_LINES_KEY, EN_NON_NATIVE_LINES_KEY, FR_LINES_KEY]:
+            logging.info("Generating " + key + " chunks of size=" + str(args.chunk_size))
+            logging.info("Analyzing chunks")
+            # Every chunk is counted, written and dropped before the next one is built
+            chunks = iter_word_chunks(lines[key], args.chunk_size)
+            if pool is not None:
+                chunks_counts = imap_windows(pool, count_chunk, chunks, POOL_WINDOW_TASKS * args.jobs * 64,
+                                             chunksize=64)
+            else:
+                chunks_counts = (count_chunk(chunk) for chunk in chunks)
+            output_chunks_counts(args.output_location, key, args.chunk_size, args.counts_format,
+                                 iter_counts_batches(chunks_counts), npy_dtype=args.npy_dtype)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def get_chunks_counters(vocab, encoded, pos_counts=True, function_word_counts=True):
+    counters = []
+    if pos_counts:
+        logging.info("Generating POS counts from words")
+        trigram_keys = packed_most_common_trigrams(
+            np.concatenate([encoded[k].tokens for k in [EN_LINES_KEY, EN_NON_NATIVE_LINES_KEY, FR_LINES_KEY]]))
+        logging.debug([tuple(vocab[i] for i in unpack_trigram(k)) for k in trigram_keys])
+        counters.append([get_packed_trigram_counts_matrix, trigram_keys])
+
+    if function_word_counts:
+        counters.append([get_func_word_counts_matrix, func_word_vocab_columns(vocab)])
+
+    assert len(counters) > 0, "No counter selected for chunks, see help for flags"
+    return counters
+
+
+# Yields every class' key, amount of chunks and count batches, the batches are used up before the next class
+def iter_chunks_counts(encoded, chunk_size, counters, jobs=1, lines_location=None, lines_format=None):
+    if lines_location is not None:
+        # Workers map the persisted token IDs themselves, tasks only carry chunk bounds
+        state = {"counters": counters, "lines_location": lines_location, "lines_format": lines_format}
+        initargs = (state,)
+    else:
+        state = {"counters": counters}
+        initargs = (state, encoded)
+    pool = Pool(jobs, initializer=set_chunk_counting_state, initargs=initargs) if jobs > 1 else None
+    set_chunk_counting_state(state, encoded)
+    try:
+        for key in [EN_LINES_KEY, EN_NON_NATIVE_LINES_KEY, FR_LINES_KEY]:
+            logging.info("Generating " + key + " chunks of size=" + str(chunk_size))
+            chunk_bounds = encoded_lines_to_chunk_bounds(encoded[key], chunk_size)
+            logging.info("Analyzing %d chunks", len(chunk_bounds))
+            tasks = ((key, chunk_bounds[batch_start:batch_start + CHUNK_BATCH_SIZE])
+                     for batch_start in range(0, len(chunk_bounds), CHUNK_BATCH_SIZE))
+            if pool is not None:
+                # imap keeps the batches in chunk order
+                chunks_counts = imap_windows(pool, count_chunks_batch, tasks, POOL_WINDOW_TASKS * jobs)
+            else:
+                chunks_counts = (count_chunks_batch(task) for task in tasks)
+            yield key, len(chunk_bounds), chunks_counts
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def count_chunks(encoded, chunk_size, counters, jobs=1):
+    # Every class' counts as one matrix in memory, for passing straight to the classifier
+    counts_by_class = {}
+    for key, chunk_amount, counts_batches in iter_chunks_counts(encoded, chunk_size, counters, jobs):
+        batches = list(counts_batches)
+        counts_by_class[key] = np.concatenate(batches) if batches else np.zeros((0, 0), dtype=np.int32)
+    return counts_by_class
+
+
+def count_chunks_vectorized(args):
+    vocab, encoded = get_encoded_corpus(args.lines_json_location, args.lines_format)
+    counters = get_chunks_counters(vocab, encoded, args.pos_counts, args.function_word_counts)
+    for key, chunk_amount, counts_batches in iter_chunks_counts(encoded, args.chunk_size, counters, args.jobs,
+                                                                args.lines_json_location, args.lines_format):
+        output_chunks_counts(args.output_location, key, args.chunk_size, args.counts_format, counts_batches,
+                             chunk_amount, args.npy_dtype)
+
+
+CHUNK_COUNTING_STATE = {}
+
+
+def set_chunk_counting_state(state, encoded=None):
+    CHUNK_COUNTING_STATE.clear()
+    CHUNK_COUNTING_STATE.update(state)
+    if encoded is None and "lines_location" in state:
+        _, encoded = get_encoded_corpus(state["lines_location"], state["lines_format"])
+    CHUNK_COUNTING_STATE["encoded"] = encoded
+
+
+def count_chunk(words):
+    return get_chunk_counts(words, CHUNK_COUNTING_STATE["counters"])
+
+
+def count_chunks_batch(task):
+    # Count vectors of CHUNK_BATCH_SIZE chunks at most
+    key, chunk_bounds = task
+    tokens = CHUNK_COUNTING_STATE["encoded"][key].tokens
+    return get_chunks_counts_matrix(tokens, chunk_bounds, CHUNK_COUNTING_STATE["counters"]).astype(np.int32)
+
+
+def iter_counts_batches(chunks_counts):
+    # Groups single chunks' count vectors into matrices of CHUNK_BATCH_SIZE rows
+    chunks_counts = iter(chunks_counts)
+    while True:
+        rows = list(itertools.islice(chunks_counts, CHUNK_BATCH_SIZE))
+        if not rows:
+            break
+        yield np.array(rows, dtype=np.int32)
+
+
+# counts_batches are count matrices of consecutive chunks
+def output_chunks_counts(output_location, key, chunk_size, counts_format, counts_batches, chunk_amount=None,
+                         npy_dtype="float32"):
+    filename = chunks_counts_filename(output_location, key, chunk_size, counts_format)
+    if counts_format == COUNTS_FORMAT_NPZ:
+        output_chunks_counts_npz(filename, counts_batches)
+    elif counts_format == COUNTS_FORMAT_NPY:
+        output_chunks_counts_npy(filename, counts_batches, chunk_amount, npy_dtype)
+    else:
+        output_chunks_counts_json(filename, counts_batches)
+
+
+def as_npy_dtype(batch, dtype):
+    if np.dtype(dtype) == np.uint16:
+        assert batch.size == 0 or batch.max() <= np.iinfo(np.uint16).max, "Counts too large for uint16, use float32"
+    return batch.astype(dtype)
+
+
+def output_chunks_counts_npy(filename, counts_batches, chunk_amount=None, npy_dtype="float32"):
+    # Dense matrix the classifier can memory-map, filled batch by batch when the amount of chunks is known
+    logging.info("Writing chunks' counts to %s", filename)
+    if chunk_amount is None:
+        batches = [as_npy_dtype(batch, npy_dtype) for batch in counts_batches]
+        np.save(filename, np.concatenate(batches) if batches else np.zeros((0, 0), dtype=npy_dtype))
+    else:
+        matrix = None
+        row = 0
+        for batch in counts_batches:
+            if matrix is None:
+                matrix = np.lib.format.open_memmap(filename, mode='w+', dtype=npy_dtype,
+                                                   shape=(chunk_amount, batch.shape[1]))
+            matrix[row:row + len(batch)] = as_npy_dtype(batch, npy_dtype)
+            row += len(batch)
+        if matrix is None:
+            np.save(filename, np.zeros((0, 0), dtype=npy_dtype))
+        else:
+            matrix.flush()
+            del matrix
+    logging.info("Done writing chunks' counts to %s", filename)
+
+
+def output_chunks_counts_npz(filename, counts_batches):
+    # Most counts are zero, so the chunks' counts are kept as a CSR matrix
+    batches = [scipy.sparse.csr_matrix(batch) for batch in counts_batches]
+    logging.info("Writing chunks' counts to %s", filename)
+    if batches:
+        matrix = scipy.sparse.vstack(batches, format='csr')
+    else:
+        matrix = scipy.sparse.csr_matrix((0, 0), dtype=np.int32)
+    scipy.sparse.save_npz(filename, matrix)
+    logging.info("Done writing chunks' counts to %s, %d non-zero counts", filename, matrix.nnz)
+
+
+def output_chunks_counts_json(filename, counts_batches):
+    # Writes the same JSON as json.dump of the whole list, one chunk's counts at a time
+    logging.info("Writing chunks' counts to %s", filename)
+    with open(filename, 'w') as f:
+        f.write("[")
+        first = True
+        for batch in counts_batches:
+            for counts in batch.tolist():
+                if not first:
+                    f.write(", ")
+                first = False
+                f.write(json.dumps(counts))
+        f.write("]")
+    logging.info("Done writing chunks' counts to %s", filename)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    set_logging(args.debug)
+
+    if args.per_chunk_counting:
+        count_chunks_per_chunk(args)
+    else:
+        count_chunks_vectorized(args)
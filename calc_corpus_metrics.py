@@ -1,9 +1,10 @@
 #!/usr/bin/python
 
 import argparse
+import itertools
 import matplotlib.pyplot as plt
-from collections import Counter
-from random import shuffle
+from collections import Counter, deque
+from multiprocessing import Pool
 
 from shared import *
 from en_idioms import IDIOMS
@@ -11,63 +12,436 @@ from en_cohesive_markers import COHESIVE_MARKERS
 from en_pronouns import PRONOUNS
 
 
-def calc_lexical_richness(words, token_count):
+LEXICAL_RICHNESS = "Lexical richness"
+COLLOCATIONS = "Collocations"
+COHESIVE_MARKERS_METRIC = "Cohesive markers"
+PERSONAL_PRONOUNS = "Personal pronouns"
+METRICS = [LEXICAL_RICHNESS, COLLOCATIONS, COHESIVE_MARKERS_METRIC, PERSONAL_PRONOUNS]
+BOOTSTRAP_BATCH_SIZE = 50
+
+
+def sample_line_spans(class_line_starts, token_count, random_state):
+    # Whole lines drawn without replacement until token_count words are covered, as (start, end) word offsets
+    lines = random_state.permutation(len(class_line_starts) - 1)
+    covered = np.cumsum(np.diff(class_line_starts)[lines])
+    lines = lines[:np.searchsorted(covered, token_count) + 1]
+    ends = class_line_starts[lines + 1]
+    # The last line is cut short so exactly token_count words are covered
+    ends[-1] -= max(covered[len(lines) - 1] - token_count, 0)
+    return zip(class_line_starts[lines].tolist(), ends.tolist())
+
+
+def iter_lines_pieces(class_words, line_spans):
+    # The lines joined, each ended by a newline so no phrase is found across two of them
+    for start, end in line_spans:
+        yield " ".join(class_words[start:end])
+        yield "\n"
+
+
+def count_rare_words(word_counts):
+    rare_words_cnt = 0
+    for cnt in word_counts.values():
+        if cnt == 1:
+            rare_words_cnt += 1
+    return rare_words_cnt
+
+
+def count_pronouns(word_counts):
+    pronoun_count = 0
+    for p in PRONOUNS:
+        pronoun_count += word_counts[p]
+    return pronoun_count
+
+
+def sample_word_counts(class_words, token_count, random_state):
+    # Counts of a uniform sample of token_count words, the class's words are neither copied nor reordered
+    if token_count >= len(class_words):
+        return Counter(class_words)
+    indices = np.sort(random_state.permutation(len(class_words))[:token_count])
+    return Counter([class_words[i] for i in indices.tolist()])
+
+
+def sample_words_counts(words, token_count, random_state=None):
+    # One sample per class, shared by the metrics counting single words
+    random_state = random_state or np.random.RandomState()
+    return {class_key: sample_word_counts(class_words, token_count, random_state)
+            for class_key, class_words in words.items()}
+
+
+def calc_lexical_richness(words, line_starts, token_count, random_state=None, word_counts=None):
     res = {}
-    for class_key, class_words in words.items():
-        shuffle(class_words)
-        c = Counter(class_words[:token_count])
-        rare_words_cnt = 0
-        for cnt in c.values():
-            if cnt == 1:
-                rare_words_cnt += 1
+    word_counts = word_counts or sample_words_counts(words, token_count, random_state)
+    for class_key in words.keys():
+        c = word_counts[class_key]
+        rare_words_cnt = count_rare_words(c)
         res[class_key] = rare_words_cnt
         logging.info("Lexical richness for class %s = %f", class_key, float(rare_words_cnt) / token_count)
     return res
 
 
-def calc_collocations(words, token_count):
+class AhoCorasick(object):
+    # Finds all patterns in one pass, counting each pattern like str.count does (non-overlapping)
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [()]
+        for pattern_id, pattern in enumerate(self.patterns):
+            node = 0
+            for ch in pattern:
+                child = self.goto[node].get(ch)
+                if child is None:
+                    child = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.outputs.append(())
+                    self.goto[node][ch] = child
+                node = child
+            self.outputs[node] += ((pattern_id, len(pattern)),)
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and ch not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(ch, 0)
+                self.outputs[child] += self.outputs[self.fail[child]]
+
+    def iter_matches(self, pieces):
+        # pieces are consecutive parts of one text, so matches may span them
+        # Yields (pattern_id, end) with end the text position right after the match
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        next_start = [0] * len(self.patterns)
+        node = 0
+        position = 0
+        for piece in pieces:
+            for ch in piece:
+                while node and ch not in goto[node]:
+                    node = fail[node]
+                node = goto[node].get(ch, 0)
+                position += 1
+                if outputs[node]:
+                    for pattern_id, length in outputs[node]:
+                        if position - length >= next_start[pattern_id]:
+                            next_start[pattern_id] = position
+                            yield pattern_id, position
+
+    def count_in_pieces(self, pieces):
+        counts = [0] * len(self.patterns)
+        for pattern_id, _ in self.iter_matches(pieces):
+            counts[pattern_id] += 1
+        return counts
+
+    def count(self, text):
+        return self.count_in_pieces([text])
+
+
+IDIOMS_AUTOMATON = None
+
+
+def get_idioms_automaton():
+    global IDIOMS_AUTOMATON
+    if IDIOMS_AUTOMATON is None:
+        # The lines are unicode, so like the str.count this replaced, idioms that are not ASCII never match
+        idioms = [i for i in IDIOMS if all(ord(ch) < 128 for ch in i)]
+        logging.info("Building idioms automaton from %d idioms", len(idioms))
+        IDIOMS_AUTOMATON = AhoCorasick(idioms)
+    return IDIOMS_AUTOMATON
+
+
+def calc_collocations(words, line_starts, token_count, random_state=None):
     res = {}
+    automaton = get_idioms_automaton()
+    random_state = random_state or np.random.RandomState()
     for class_key, class_words in words.items():
-        collocation_count = 0
-        super_string = " ".join(class_words[:token_count])
-        for i in IDIOMS:
-            try:
-                collocation_count += super_string.count(i)
-            except UnicodeDecodeError:
-                pass
+        line_spans = sample_line_spans(line_starts[class_key], token_count, random_state)
+        idiom_counts = automaton.count_in_pieces(iter_lines_pieces(class_words, line_spans))
+        collocation_count = sum(idiom_counts)
+        logging.debug("Idioms found in class %s: %s", class_key,
+                      sorted([(c, i) for c, i in zip(idiom_counts, automaton.patterns) if c > 0], reverse=True))
         res[class_key] = collocation_count
         logging.info("Collocation metric for class %s = %f", class_key, float(collocation_count) / token_count)
     return res
 
 
-def calc_cohesive_markers(words, token_count):
+class PhraseTrie(object):
+    # Finds whole-word phrases in a token sequence, every occurrence of every phrase is counted
+
+    def __init__(self, phrases):
+        # Each phrase is a sequence of tokens
+        self.phrases = list(phrases)
+        self.root = {}
+        for phrase_id, phrase in enumerate(self.phrases):
+            node = self.root
+            for token in phrase:
+                node = node.setdefault(token, {})
+            # None never is a token, so it marks the phrases ending at a node
+            node.setdefault(None, []).append(phrase_id)
+
+    def step(self, partial_matches, token, counts):
+        # Extends the phrases matched so far by one token, returns the ones still matching
+        next_partial_matches = []
+        node = self.root.get(token)
+        if node is not None:
+            next_partial_matches.append(node)
+        for node in partial_matches:
+            node = node.get(token)
+            if node is not None:
+                next_partial_matches.append(node)
+        for node in next_partial_matches:
+            for phrase_id in node.get(None, ()):
+                counts[phrase_id] += 1
+        return next_partial_matches
+
+    def iter_matches(self, tokens, token_amount=None):
+        # Yields (phrase_id, start, end) for the tokens[start:end] matching a phrase
+        root = self.root
+        token_amount = len(tokens) if token_amount is None else min(token_amount, len(tokens))
+        for i in range(token_amount):
+            node = root.get(tokens[i])
+            j = i + 1
+            while node is not None:
+                for phrase_id in node.get(None, ()):
+                    yield phrase_id, i, j
+                if j == token_amount:
+                    break
+                node = node.get(tokens[j])
+                j += 1
+
+    def count(self, tokens, token_amount=None):
+        counts = [0] * len(self.phrases)
+        for phrase_id, _, _ in self.iter_matches(tokens, token_amount):
+            counts[phrase_id] += 1
+        return counts
+
+    def count_in_lines(self, lines):
+        # Phrases are only matched within a line
+        counts = [0] * len(self.phrases)
+        for tokens in lines:
+            for phrase_id, _, _ in self.iter_matches(tokens):
+                counts[phrase_id] += 1
+        return counts
+
+
+COHESIVE_MARKERS_TRIE = None
+COHESIVE_MARKERS_AUTOMATON = None
+
+
+def get_cohesive_markers_trie():
+    global COHESIVE_MARKERS_TRIE
+    if COHESIVE_MARKERS_TRIE is None:
+        COHESIVE_MARKERS_TRIE = PhraseTrie([m.split() for m in COHESIVE_MARKERS])
+    return COHESIVE_MARKERS_TRIE
+
+
+def get_cohesive_markers_automaton():
+    global COHESIVE_MARKERS_AUTOMATON
+    if COHESIVE_MARKERS_AUTOMATON is None:
+        COHESIVE_MARKERS_AUTOMATON = AhoCorasick(COHESIVE_MARKERS)
+    return COHESIVE_MARKERS_AUTOMATON
+
+
+def calc_cohesive_markers(words, line_starts, token_count, random_state=None):
     res = {}
+    trie = get_cohesive_markers_trie()
+    random_state = random_state or np.random.RandomState()
     for class_key, class_words in words.items():
-        cohesive_markers_used = 0
-        super_string = " ".join(class_words[:token_count])
-        for m in COHESIVE_MARKERS:
-            try:
-                cohesive_markers_used += super_string.count(m)
-            except UnicodeDecodeError:
-                pass
+        line_spans = sample_line_spans(line_starts[class_key], token_count, random_state)
+        marker_counts = trie.count_in_lines(class_words[start:end] for start, end in line_spans)
+        cohesive_markers_used = sum(marker_counts)
+        logging.debug("Cohesive markers found in class %s: %s", class_key,
+                      sorted([(c, m) for c, m in zip(marker_counts, COHESIVE_MARKERS) if c > 0], reverse=True))
         res[class_key] = cohesive_markers_used
         logging.info("Cohesive markers metric for class %s = %f", class_key, float(cohesive_markers_used) / token_count)
     return res
 
 
-def calc_personal_pronouns(words, token_count):
+# Previous metric, markers are counted as substrings so 'and' is also found in 'band'
+def calc_cohesive_markers_substrings(words, line_starts, token_count, random_state=None):
     res = {}
+    automaton = get_cohesive_markers_automaton()
+    random_state = random_state or np.random.RandomState()
     for class_key, class_words in words.items():
-        shuffle(class_words)
-        c = Counter(class_words[:token_count])
-        pronoun_count = 0
-        for p in PRONOUNS:
-            pronoun_count += c[p]
+        line_spans = sample_line_spans(line_starts[class_key], token_count, random_state)
+        cohesive_markers_used = sum(automaton.count_in_pieces(iter_lines_pieces(class_words, line_spans)))
+        res[class_key] = cohesive_markers_used
+        logging.info("Cohesive markers (substrings) metric for class %s = %f", class_key,
+                     float(cohesive_markers_used) / token_count)
+    return res
+
+
+def calc_personal_pronouns(words, line_starts, token_count, random_state=None, word_counts=None):
+    res = {}
+    word_counts = word_counts or sample_words_counts(words, token_count, random_state)
+    for class_key in words.keys():
+        c = word_counts[class_key]
+        pronoun_count = count_pronouns(c)
         res[class_key] = pronoun_count
         logging.info("Personal pronouns metric for class %s = %f", class_key, float(pronoun_count) / token_count)
     return res
 
 
+def calc_class_metrics_fused(class_words, class_line_starts, token_count, random_state, line_random_state):
+    # All four metrics of a class, the phrase matchers share one pass over its sampled lines
+    automaton = get_idioms_automaton()
+    trie = get_cohesive_markers_trie()
+    # Sampled once for both lexical richness and personal pronouns
+    word_counts = sample_word_counts(class_words, token_count, random_state)
+    line_spans = sample_line_spans(class_line_starts, token_count, line_random_state)
+    marker_counts = [0] * len(trie.phrases)
+
+    def lines_pieces():
+        starts_phrase = trie.root.get
+        for start, end in line_spans:
+            line_words = class_words[start:end]
+            partial_matches = []
+            for w in line_words:
+                if partial_matches or starts_phrase(w) is not None:
+                    partial_matches = trie.step(partial_matches, w, marker_counts)
+            yield " ".join(line_words)
+            yield "\n"
+
+    idiom_counts = automaton.count_in_pieces(lines_pieces())
+    return {
+        LEXICAL_RICHNESS: count_rare_words(word_counts),
+        COLLOCATIONS: sum(idiom_counts),
+        COHESIVE_MARKERS_METRIC: sum(marker_counts),
+        PERSONAL_PRONOUNS: count_pronouns(word_counts)
+    }
+
+
+def calc_metrics_fused(words, line_starts, token_count, random_state=None):
+    res = {metric: {} for metric in METRICS}
+    random_state = random_state or np.random.RandomState()
+    # Lines are drawn from their own copy of the state, so the samples are the ones the separate metrics draw
+    line_random_state = np.random.RandomState()
+    line_random_state.set_state(random_state.get_state())
+    for class_key, class_words in words.items():
+        class_res = calc_class_metrics_fused(class_words, line_starts[class_key], token_count, random_state,
+                                             line_random_state)
+        for metric, value in class_res.items():
+            res[metric][class_key] = value
+            logging.info("%s metric for class %s = %f", metric, class_key, float(value) / token_count)
+    return res
+
+
+def line_idiom_counts(encoded_lines, vocab):
+    # Idioms found within each line, lines are fed with a newline so no idiom spans two of them
+    line_ends = []
+
+    def lines_pieces():
+        position = 0
+        for i in range(len(encoded_lines)):
+            line = " ".join([vocab[t] for t in encoded_lines.line(i).tolist()]) + "\n"
+            position += len(line)
+            line_ends.append(position)
+            yield line
+
+    match_ends = [end for _, end in get_idioms_automaton().iter_matches(lines_pieces())]
+    match_lines = np.searchsorted(np.array(line_ends, dtype=np.int64), np.array(match_ends, dtype=np.int64) - 1, side='right')
+    return np.bincount(match_lines, minlength=len(encoded_lines))
+
+
+def line_cohesive_marker_counts(encoded_lines, vocab):
+    word_ids = {w: i for i, w in enumerate(vocab)}
+    # Markers with a word missing from the vocabulary get ID -1 and never match
+    trie = PhraseTrie([[word_ids.get(w, -1) for w in m.split()] for m in COHESIVE_MARKERS])
+    starts = []
+    ends = []
+    for _, start, end in trie.iter_matches(encoded_lines.tokens.tolist()):
+        starts.append(start)
+        ends.append(end)
+    match_lines = np.searchsorted(encoded_lines.line_starts, np.array(starts, dtype=np.int64), side='right') - 1
+    within_line = np.array(ends, dtype=np.int64) <= encoded_lines.line_starts[match_lines + 1]
+    return np.bincount(match_lines[within_line], minlength=len(encoded_lines))
+
+
+def get_bootstrap_class_data(encoded_lines, vocab, token_count):
+    word_ids = {w: i for i, w in enumerate(vocab)}
+    word_counts = np.bincount(encoded_lines.tokens, minlength=len(vocab))
+    line_lengths = encoded_lines.line_lengths()
+    # Lines with the same length and phrase counts are interchangeable, so they are drawn as one group
+    line_groups, line_group_sizes = np.unique(np.stack([line_lengths, line_idiom_counts(encoded_lines, vocab),
+                                                        line_cohesive_marker_counts(encoded_lines, vocab)], axis=1),
+                                              axis=0, return_counts=True)
+    return {
+        "word_probabilities": word_counts / float(word_counts.sum()),
+        "pronoun_ids": np.array([word_ids[p] for p in PRONOUNS if p in word_ids], dtype=np.int64),
+        "line_groups": line_groups,
+        "line_group_probabilities": line_group_sizes / float(line_group_sizes.sum()),
+        "token_count": token_count,
+        # Lines drawn per resample, about token_count words at the class's mean line length
+        "line_amount": max(int(round(token_count / max(line_lengths.mean(), 1))), 1)
+    }
+
+
+BOOTSTRAP_DATA = {}
+
+
+def set_bootstrap_data(bootstrap_data):
+    BOOTSTRAP_DATA.update(bootstrap_data)
+
+
+def bootstrap_batch(task):
+    # Every class is resampled with replacement at the same token_count, so the CIs compare across classes.
+    # Token metrics draw word counts from a multinomial over the class's vocabulary, phrase metrics draw
+    # lines from a multinomial over the line groups and are divided by the words those lines cover
+    class_key, seed, resample_amount = task
+    data = BOOTSTRAP_DATA[class_key]
+    random_state = np.random.RandomState(seed)
+    token_count = float(data["token_count"])
+    res = {metric: np.zeros(resample_amount) for metric in METRICS}
+    for r in range(resample_amount):
+        word_counts = random_state.multinomial(data["token_count"], data["word_probabilities"])
+        res[LEXICAL_RICHNESS][r] = np.count_nonzero(word_counts == 1) / token_count
+        res[PERSONAL_PRONOUNS][r] = word_counts[data["pronoun_ids"]].sum() / token_count
+        group_counts = random_state.multinomial(data["line_amount"], data["line_group_probabilities"])
+        covered, idioms, markers = group_counts.dot(data["line_groups"])
+        res[COLLOCATIONS][r] = idioms / float(max(covered, 1))
+        res[COHESIVE_MARKERS_METRIC][r] = markers / float(max(covered, 1))
+    return class_key, res
+
+
+def calc_metrics_bootstrap(vocab, encoded, token_count, resample_amount, workers=1, seed=None, confidence=0.95):
+    # Collocations and cohesive markers only count phrases within a line, as the point estimates do
+    bootstrap_data = {}
+    for class_key, encoded_lines in encoded.items():
+        logging.info("Preparing class %s for bootstrap", class_key)
+        bootstrap_data[class_key] = get_bootstrap_class_data(encoded_lines, vocab, token_count)
+    if seed is None:
+        seed = np.random.randint(2 ** 31)
+    # Batches get their own seeds so the results do not depend on the amount of workers
+    tasks = []
+    for class_index, class_key in enumerate(sorted(encoded.keys())):
+        for batch_start in range(0, resample_amount, BOOTSTRAP_BATCH_SIZE):
+            tasks.append((class_key, [seed, class_index, batch_start],
+                          min(BOOTSTRAP_BATCH_SIZE, resample_amount - batch_start)))
+    logging.info("Running %d resamples per class with %d workers", resample_amount, workers)
+    if workers > 1:
+        pool = Pool(workers, initializer=set_bootstrap_data, initargs=(bootstrap_data,))
+        try:
+            batches = pool.map(bootstrap_batch, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        set_bootstrap_data(bootstrap_data)
+        batches = [bootstrap_batch(task) for task in tasks]
+
+    res = {metric: {} for metric in METRICS}
+    for metric in METRICS:
+        for class_key in encoded.keys():
+            values = np.concatenate([batch[metric] for k, batch in batches if k == class_key])
+            low, high = np.percentile(values, [50 * (1 - confidence), 50 * (1 + confidence)])
+            res[metric][class_key] = (values.mean(), low, high)
+            logging.info("%s metric for class %s = %f (%d%% CI %f - %f)", metric, class_key, values.mean(),
+                         100 * confidence, low, high)
+    return res
+
+
 def plot_metrics(metrics_by_class, metric_keys):
     class_keys = metrics_by_class.keys()
     # Setting the positions and width for the bars
@@ -107,37 +481,79 @@ def parse_args():
     p = argparse.ArgumentParser()
     p.add_argument("-d","--debug",action='store_true')
     p.add_argument("-j","--lines-json-location",default="/tmp/")
+    p.add_argument("--lines-format",choices=LINES_FORMATS,default=LINES_FORMAT_JSON)
     p.add_argument("--lines-from-file",action='store_true', help="Bypasses the speaker separation part")
     p.add_argument("--show-graph",action='store_true')
+    p.add_argument("--substring-markers",action='store_true', help="Count cohesive markers as substrings like before, for comparison")
+    p.add_argument("--seed",type=int, help="Seed for sampling the words and lines of each class")
+    p.add_argument("--bootstrap",type=int,default=0, help="Amount of resamples per class for confidence intervals, 0 to skip")
+    p.add_argument("--confidence",type=float,default=0.95)
+    p.add_argument("-w","--workers",type=int,default=1, help="Amount of processes running the bootstrap resamples")
+    p.add_argument("--separate-metrics",action='store_true', help="Calculate every metric in its own pass instead of the fused pass")
     return p.parse_args()
 
 
-if __name__ == '__main__':
-    args = parse_args()
-    set_logging(args.debug)
-
-    lines = load_lines_json(args.lines_json_location)
-
-    words = lines_dict_to_words_dict(lines)
+def calc_metrics(lines, seed=None, substring_markers=False, separate_metrics=False):
+    words, line_starts = lines_dict_to_words_and_line_starts(lines)
 
     metrics = {
-        "Lexical richness": calc_lexical_richness,
-        "Collocations": calc_collocations,
-        "Cohesive markers": calc_cohesive_markers,
-        "Personal pronouns": calc_personal_pronouns
+        LEXICAL_RICHNESS: calc_lexical_richness,
+        COLLOCATIONS: calc_collocations,
+        COHESIVE_MARKERS_METRIC: calc_cohesive_markers_substrings if substring_markers else calc_cohesive_markers,
+        PERSONAL_PRONOUNS: calc_personal_pronouns
     }
     min_token_count = min([len(l) for l in words.values()])
     logging.info("Token amount for metric calculations = %d", min_token_count)
 
+    log_peak_rss("before metrics")
+    results = {}
+    if separate_metrics or substring_markers:
+        word_counts = sample_words_counts(words, min_token_count, np.random.RandomState(seed))
+        for metric, calc in metrics.items():
+            logging.info("Generating the %s metric from words",metric)
+            if metric in (LEXICAL_RICHNESS, PERSONAL_PRONOUNS):
+                results[metric] = calc(words, line_starts, min_token_count, word_counts=word_counts)
+            else:
+                results[metric] = calc(words, line_starts, min_token_count, np.random.RandomState(seed))
+    else:
+        logging.info("Generating all metrics from words in one pass")
+        results = calc_metrics_fused(words, line_starts, min_token_count, np.random.RandomState(seed))
+
     normalized_results_by_class = {key: list() for key in words.keys()}
-    for metric, calc in metrics.items():
-        logging.info("Generating the %s metric from words",metric)
-        result = calc(words, min_token_count)
+    for metric in metrics.keys():
+        logging.info("Normalizing the %s metric", metric)
+        result = results[metric]
         res_sum = sum(result.values())
         for class_key, class_result in result.items():
             normalized_res = float(class_result)/res_sum
             logging.info("Normalized (total sum) for class %s = %f", class_key, normalized_res)
             normalized_results_by_class[class_key].append(normalized_res)
+    log_peak_rss("after metrics")
+    return normalized_results_by_class, metrics.keys()
 
+
+def calc_metrics_once(args):
+    lines = load_lines(args.lines_json_location, args.lines_format)
+    normalized_results_by_class, metric_keys = calc_metrics(lines, args.seed, args.substring_markers,
+                                                            args.separate_metrics)
     if args.show_graph:
-        plot_metrics(normalized_results_by_class,metrics.keys())
+        plot_metrics(normalized_results_by_class, metric_keys)
+
+
+def calc_metrics_with_bootstrap(args):
+    vocab, encoded = get_encoded_corpus(args.lines_json_location, args.lines_format)
+    min_token_count = min([len(e.tokens) for e in encoded.values()])
+    logging.info("Token amount for metric calculations = %d", min_token_count)
+    log_peak_rss("before metrics")
+    calc_metrics_bootstrap(vocab, encoded, min_token_count, args.bootstrap, args.workers, args.seed, args.confidence)
+    log_peak_rss("after metrics")
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    set_logging(args.debug)
+
+    if args.bootstrap > 0:
+        calc_metrics_with_bootstrap(args)
+    else:
+        calc_metrics_once(args)
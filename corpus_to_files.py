@@ -1,13 +1,24 @@
 #!/usr/bin/python
 
 import argparse
+import os
+import re
 import xml.etree.ElementTree as etree
 import matplotlib.pyplot as plt
+from collections import OrderedDict
+from multiprocessing import Pool
 
 from shared import *
 
 
-def separate_identification(line):
+# A single self-closing tag with plain double-quoted attributes, e.g.
+# <SPEAKER COUNT="1" NAME="Mr. Smith" LANGUAGE="EN" />
+ID_LINE_RE = re.compile(r'^\s*<\w+((?:\s+\w+="[^"<&\t\r\n]*")*)\s*/>\s*$')
+ID_ATTRIBUTE_RE = re.compile(r'(\w+)="([^"]*)"')
+ID_ATTRIBUTES = {"COUNT", "NAME", "LANGUAGE"}
+
+
+def separate_identification_etree(line):
     tree = etree.fromstring(line)
     line_count = tree.attrib["COUNT"]
     name = tree.attrib["NAME"]
@@ -15,19 +26,97 @@ def separate_identification(line):
     return line_count, name, lang
 
 
+def separate_identification(line):
+    match = ID_LINE_RE.match(line)
+    if match is None:
+        # Escaped entities, other tag shapes and malformed lines are left to ElementTree
+        return separate_identification_etree(line)
+    attribute_pairs = ID_ATTRIBUTE_RE.findall(match.group(1))
+    attributes = dict(attribute_pairs)
+    if len(attributes) != len(attribute_pairs) or not ID_ATTRIBUTES.issubset(attributes):
+        return separate_identification_etree(line)
+    name = attributes["NAME"]
+    if isinstance(name, bytes):
+        try:
+            name.decode("ascii")
+        except UnicodeDecodeError:
+            # ElementTree hands back unicode for non-ASCII values, keep the speakers keys the same
+            name = name.decode("utf-8")
+    return attributes["COUNT"], name, attributes["LANGUAGE"]
+
+
+def add_speaker_line(speakers, line_count, name, lang):
+    if name not in speakers:
+        speakers[name] = {}
+        speakers[name][EN_LINES_KEY] = []
+        speakers[name][FR_LINES_KEY] = []
+    speakers[name][lang+"_LINES"].append(line_count)
+
+
 def add_speakers_lines_from_id_file(filename):
     speakers = {}
     logging.info("Running speaker extraction from "+filename)
-    logging.info("Loading IDs from %s", filename)
-    id_file_as_list = open(filename).read().splitlines()
-    logging.info("Done loading IDs from %s", filename)
-    for line in id_file_as_list:
-        line_count, name, lang = separate_identification(line)
+    # Stream the IDs line by line so memory depends on the speakers, not on the file size
+    with open(filename) as id_file:
+        for line in id_file:
+            add_speaker_line(speakers, *separate_identification(line.rstrip("\r\n")))
+    logging.info("Done streaming IDs from %s", filename)
+    logging.info("Found %d speakers", len(speakers))
+    return speakers
+
+
+def split_file_to_line_ranges(filename, parts):
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename) as f:
+        for i in range(1, parts):
+            # Move each cut forward to the start of the next line
+            f.seek(size * i // parts)
+            f.readline()
+            bounds.append(max(f.tell(), bounds[-1]))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def add_speakers_lines_from_id_range(id_range):
+    filename, start, end = id_range
+    # Speakers in first-seen order, so merging the ranges in order inserts them like the serial pass does
+    speakers = OrderedDict()
+    with open(filename) as id_file:
+        id_file.seek(start)
+        position = start
+        while position < end:
+            line = id_file.readline()
+            if not line:
+                break
+            position += len(line)
+            add_speaker_line(speakers, *separate_identification(line.rstrip("\r\n")))
+    return speakers
+
+
+def merge_speakers_lines(speakers, other_speakers):
+    for name, lines in other_speakers.items():
         if name not in speakers:
-            speakers[name] = {}
-            speakers[name][EN_LINES_KEY] = []
-            speakers[name][FR_LINES_KEY] = []
-        speakers[name][lang+"_LINES"].append(line_count)
+            speakers[name] = lines
+        else:
+            speakers[name][EN_LINES_KEY].extend(lines[EN_LINES_KEY])
+            speakers[name][FR_LINES_KEY].extend(lines[FR_LINES_KEY])
+
+
+def add_speakers_lines_from_id_file_parallel(filename, workers):
+    logging.info("Running speaker extraction from %s with %d workers", filename, workers)
+    id_ranges = [(filename, start, end) for start, end in split_file_to_line_ranges(filename, workers)]
+    pool = Pool(workers)
+    try:
+        # Ranges come back in file order so every speaker's lines keep the serial order
+        speakers_by_range = pool.map(add_speakers_lines_from_id_range, id_ranges)
+    finally:
+        pool.close()
+        pool.join()
+    # A plain dict filled in the serial insertion order iterates like the serial one, which sets the lines' order
+    speakers = {}
+    for range_speakers in speakers_by_range:
+        merge_speakers_lines(speakers, range_speakers)
     logging.info("Found %d speakers", len(speakers))
     return speakers
 
@@ -40,7 +129,7 @@ def output_speakers_json(output_location, speakers):
 
 
 def output_lines_json(output_location, lines):
-    output = output_location + "lines-out.json"
+    output = output_location + LINES_JSON_FILENAME
     logging.info("Outputting lines to %s", output)
     with open(output, 'w') as out:
         json.dump(lines, out, indent=4, separators=(',', ': '))
@@ -76,8 +165,11 @@ def create_minimum_lines_speakers_graph(speakers):
     plt.show()
 
 
-def get_speakers_stats_from_id_file(file_pattern):
-    speakers = add_speakers_lines_from_id_file(file_pattern + ID_SUFFIX)
+def get_speakers_stats_from_id_file(file_pattern, workers=1):
+    if workers > 1:
+        speakers = add_speakers_lines_from_id_file_parallel(file_pattern + ID_SUFFIX, workers)
+    else:
+        speakers = add_speakers_lines_from_id_file(file_pattern + ID_SUFFIX)
     logging.info("Found " + str(len(speakers)) + " total speakers")
     add_speakers_stats(speakers)
     return speakers
@@ -118,14 +210,142 @@ def check_class_list(class_list):
     assert len(class_list) > 0, "Class list is empty..."
 
 
+def check_lines_by_class(line_nums_by_class):
+    logging.info("Checking for line class list problems...")
+    for key in [EN_LINES_KEY, EN_NON_NATIVE_LINES_KEY, FR_LINES_KEY]:
+        check_class_list(line_nums_by_class[key])
+    logging.info("All Good!")
+
+
+def split_lines_by_class(speakers, threshold):
+    en_native_line_nums, en_non_native_line_nums, en_translated_line_nums = separate_lines_by_lang(speakers, threshold)
+
+    line_nums_by_class = {
+        EN_LINES_KEY: map(lambda i: int(i), en_native_line_nums),
+        EN_NON_NATIVE_LINES_KEY: map(lambda i: int(i), en_non_native_line_nums),
+        FR_LINES_KEY: map(lambda i: int(i), en_translated_line_nums)
+    }
+    check_lines_by_class(line_nums_by_class)
+    return line_nums_by_class
+
+
+def sort_speakers_by_fr_percent(speakers):
+    # Possibly non-native speakers' English lines, most French speaker first, so every threshold's class is a prefix
+    candidates = [(rank, speaker) for rank, speaker in enumerate(speakers.keys())
+                  if speakers[speaker][EN_PERCENT_KEY] != 1.0]
+    candidates.sort(key=lambda c: -speakers[c[1]][FR_PERCENT_KEY])
+    fr_percents = np.array([speakers[s][FR_PERCENT_KEY] for _, s in candidates], dtype=np.float64)
+    lines_amounts = [len(speakers[s][EN_LINES_KEY]) for _, s in candidates]
+    line_nums = np.array([int(i) for _, s in candidates for i in speakers[s][EN_LINES_KEY]], dtype=np.int64)
+    # Rank of the speaker of every line in the speakers' order, to restore the order of separate_lines_by_lang
+    speaker_ranks = np.repeat(np.array([rank for rank, _ in candidates], dtype=np.int64), lines_amounts)
+    line_ends = np.cumsum([0] + lines_amounts)
+    return fr_percents, line_ends, line_nums, speaker_ranks
+
+
+def iter_lines_by_class_for_thresholds(speakers, thresholds):
+    # Same classes as split_lines_by_class for every threshold, sorting the speakers once
+    en_native_line_nums = []
+    en_translated_line_nums = []
+    for speaker in speakers.keys():
+        if speakers[speaker][EN_PERCENT_KEY] == 1.0:
+            en_native_line_nums.extend(int(i) for i in speakers[speaker][EN_LINES_KEY])
+        en_translated_line_nums.extend(int(i) for i in speakers[speaker][FR_LINES_KEY])
+
+    fr_percents, line_ends, line_nums, speaker_ranks = sort_speakers_by_fr_percent(speakers)
+    for threshold in thresholds:
+        # Speakers with at least threshold of their lines in French are the first speakers_amount ones
+        speakers_amount = np.searchsorted(-fr_percents, -threshold, side='right')
+        end = line_ends[speakers_amount]
+        order = np.argsort(speaker_ranks[:end], kind='mergesort')
+        line_nums_by_class = {
+            EN_LINES_KEY: en_native_line_nums,
+            EN_NON_NATIVE_LINES_KEY: line_nums[:end][order].tolist(),
+            FR_LINES_KEY: en_translated_line_nums
+        }
+        logging.info("Threshold %f: %d English native lines; %d English non-native lines; %d Translated English lines",
+                     threshold, len(en_native_line_nums), end, len(en_translated_line_nums))
+        yield threshold, line_nums_by_class
+
+
+def select_class_lines(en_lines_store, line_nums_by_class, decode=False):
+    # Line numbers are 1-based, the store's are 0-based
+    return {k: en_lines_store.select([i - 1 for i in nums], decode) for k, nums in line_nums_by_class.items()}
+
+
+def threshold_output_location(output_location, threshold):
+    return output_location + "threshold-{}/".format(threshold)
+
+
+def output_classes(output_location, en_filename, en_lines_store, line_nums_by_class, lines_format, encode):
+    if LINES_FORMAT_LINE_NUMBERS in lines_format:
+        output_lines_line_numbers(output_location, en_filename, line_nums_by_class)
+
+    if LINES_FORMAT_JSON in lines_format or LINES_FORMAT_BINARY in lines_format:
+        lines = {}
+        class_lines = select_class_lines(en_lines_store, line_nums_by_class)
+        for key in [EN_LINES_KEY, EN_NON_NATIVE_LINES_KEY, FR_LINES_KEY]:
+            logging.info("Extracting %s", key)
+            lines[key] = list(class_lines[key])
+
+        if LINES_FORMAT_JSON in lines_format:
+            output_lines_json(output_location, lines)
+        if LINES_FORMAT_BINARY in lines_format:
+            output_lines_binary(output_location, lines)
+
+    if encode:
+        class_lines = select_class_lines(en_lines_store, line_nums_by_class)
+        vocab, encoded = encode_lines_dict(class_lines)
+        output_encoded_corpus(output_location, vocab, encoded,
+                              [output_location + lines_filename(f) for f in lines_format])
+
+
+def thresholds_list(value):
+    try:
+        thresholds = [float(t) for t in value.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is not a comma separated list of thresholds" % value)
+    if any(t < 0 or t > 1 for t in thresholds):
+        raise argparse.ArgumentTypeError("Thresholds must be between 0 and 1")
+    return thresholds
+
+
+def output_speakers_classes(args, speakers):
+    en_filename = args.file_pattern + EN_SUFFIX
+    # The corpus is indexed and mapped once, for all thresholds when sweeping
+    en_lines_store = None
+    if args.encode or LINES_FORMAT_JSON in args.lines_format or LINES_FORMAT_BINARY in args.lines_format:
+        en_lines_store = LineStore(en_filename, args.output_location)
+    if args.thresholds is None:
+        line_nums_by_class = split_lines_by_class(speakers, args.threshold)
+        output_classes(args.output_location, en_filename, en_lines_store, line_nums_by_class, args.lines_format,
+                       args.encode)
+    else:
+        for threshold, line_nums_by_class in iter_lines_by_class_for_thresholds(speakers, args.thresholds):
+            if len(line_nums_by_class[EN_NON_NATIVE_LINES_KEY]) == 0:
+                logging.warning("No English non-native lines for threshold %f, skipping it", threshold)
+                continue
+            check_lines_by_class(line_nums_by_class)
+            output_location = threshold_output_location(args.output_location, threshold)
+            if not os.path.isdir(output_location):
+                os.makedirs(output_location)
+            output_classes(output_location, en_filename, en_lines_store, line_nums_by_class, args.lines_format,
+                           args.encode)
+
+
 def parse_args():
     p = argparse.ArgumentParser()
     p.add_argument("-d","--debug",action='store_true')
     p.add_argument("-p","--file-pattern", required=True, help="The base file name pattern where the files with suffixes {%s,%s,%s} are"%(ID_SUFFIX, EN_SUFFIX, FR_SUFFIX))
     p.add_argument("--output-location",default="/tmp/")
     p.add_argument("--speaker-stats-from-file",action='store_true')
+    p.add_argument("--speakers-only",action='store_true', help="Only write the speakers' stats, without splitting the lines to classes")
+    p.add_argument("-w","--workers",type=int,default=1, help="Amount of processes parsing the %s file"%ID_SUFFIX)
     p.add_argument("--show-graph",action='store_true')
+    p.add_argument("--lines-format",nargs='+',choices=LINES_FORMATS,default=[LINES_FORMAT_JSON], help="Output formats for the class lines")
+    p.add_argument("--encode",action='store_true', help="Also write the classes as vocabulary IDs for the later stages")
     p.add_argument("-t","--threshold",type=float,default=0.5, choices=[x/10.0 for x in xrange(0, 10, 1)])
+    p.add_argument("--thresholds",type=thresholds_list, help="Comma separated thresholds to sweep, each written to a threshold-<value> directory in the output location")
     return p.parse_args()
 
 
@@ -137,42 +357,11 @@ if __name__ == '__main__':
     if args.speaker_stats_from_file:
         speakers = load_speakers_json(args.output_location)
     else:
-        speakers = get_speakers_stats_from_id_file(args.file_pattern)
+        speakers = get_speakers_stats_from_id_file(args.file_pattern, args.workers)
         output_speakers_json(args.output_location, speakers)
 
     if args.show_graph:
         create_minimum_lines_speakers_graph(speakers)
 
-    en_native_line_nums, en_non_native_line_nums, en_translated_line_nums = separate_lines_by_lang(speakers, args.threshold)
-
-    en_native_line_nums = map(lambda i: int(i), en_native_line_nums)
-    en_non_native_line_nums = map(lambda i: int(i), en_non_native_line_nums)
-    en_translated_line_nums = map(lambda i: int(i), en_translated_line_nums)
-
-    logging.info("Checking for line class list problems...")
-    check_class_list(en_native_line_nums)
-    check_class_list(en_non_native_line_nums)
-    check_class_list(en_translated_line_nums)
-    logging.info("All Good!")
-
-    lines = {
-        EN_LINES_KEY: [],
-        EN_NON_NATIVE_LINES_KEY: [],
-        FR_LINES_KEY: []
-    }
-    f = args.file_pattern + EN_SUFFIX
-    logging.info("Loading lines from %s", f)
-    lines_file_as_list = open(f).read().splitlines()
-    logging.info("Done loading lines from %s", f)
-
-    logging.info("Extracting %s", EN_LINES_KEY)
-    lines[EN_LINES_KEY] = [lines_file_as_list[i - 1] for i in en_native_line_nums]
-
-    logging.info("Extracting %s", EN_NON_NATIVE_LINES_KEY)
-    lines[EN_NON_NATIVE_LINES_KEY] = [lines_file_as_list[i - 1] for i in en_non_native_line_nums]
-
-    logging.info("Extracting %s", FR_LINES_KEY)
-    lines[FR_LINES_KEY] = [lines_file_as_list[i - 1] for i in en_translated_line_nums]
-
-    output_lines_json(args.output_location, lines)
-
+    if not args.speakers_only:
+        output_speakers_classes(args, speakers)
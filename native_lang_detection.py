@@ -1,9 +1,14 @@
 #!/usr/bin/python
 
 import argparse
+import hashlib
+import random
+import time
 import numpy as np
+import scipy.sparse
+from multiprocessing import Pool
 from random import shuffle
-from sklearn.cross_validation import StratifiedKFold, cross_val_score
+from sklearn.cross_validation import StratifiedKFold
 from sklearn.ensemble import RandomForestClassifier
 
 from shared import *
@@ -18,15 +23,225 @@ def load_chunks_by_class(filename, sample_size):
         return chunks
 
 
-def score_cross_validated(chunks_list, classes_list):
-    data = np.concatenate(chunks_list)
+def load_chunks_counts(input_location, key, chunk_size, counts_format):
+    filename = chunks_counts_filename(input_location, key, chunk_size, counts_format)
+    logging.info("Loading chunks from %s", filename)
+    if counts_format == COUNTS_FORMAT_NPY:
+        return np.load(filename, mmap_mode='r')
+    if counts_format == COUNTS_FORMAT_NPZ:
+        return scipy.sparse.load_npz(filename).tocsr()
+    return json.load(open(filename))
+
+
+def sample_chunks_frequencies(chunks, sample_size, chunk_size):
+    if scipy.sparse.issparse(chunks):
+        # Shuffled sample of the rows, counts to frequencies without leaving the sparse matrix
+        sample = chunks[np.random.permutation(chunks.shape[0])[:sample_size]]
+        return sample.astype(np.float64) * (1 / float(chunk_size))
+    if isinstance(chunks, np.ndarray):
+        # Only the sampled rows are read from the memory-mapped matrix, then turned to frequencies in place
+        sample = chunks[np.random.permutation(chunks.shape[0])[:sample_size]]
+        if sample.dtype != np.float32 or not sample.flags.writeable:
+            sample = sample.astype(np.float32)
+        sample /= float(chunk_size)
+        return sample
+    # Shuffle chunks used for better lexical diversity
+    shuffle(chunks)
+    # Use only sample_size chunks
+    chunks = chunks[:sample_size]
+    # counts to frequencies
+    chunks = map(lambda chunk: [count / float(chunk_size) for count in chunk], chunks)
+    return np.asarray(chunks, np.float)
+
+
+EXPERIMENTS = [[EN_LINES_KEY, FR_LINES_KEY],
+               [FR_LINES_KEY, EN_NON_NATIVE_LINES_KEY],
+               [EN_LINES_KEY, EN_NON_NATIVE_LINES_KEY],
+               [EN_LINES_KEY, EN_NON_NATIVE_LINES_KEY, FR_LINES_KEY]]
+FOLD_AMOUNT = 10
+
+
+def get_experiment_data(chunks_list, classes_list):
+    if any(scipy.sparse.issparse(c) for c in chunks_list):
+        data = scipy.sparse.vstack(chunks_list, format='csr')
+    else:
+        data = np.concatenate(chunks_list)
     target = np.concatenate(classes_list)
-    clf = RandomForestClassifier(n_estimators=20)
-    cv = StratifiedKFold(target, n_folds=10)
-    # Valid scoring options are ['accuracy', 'adjusted_rand_score', 'average_precision', 'f1', 'log_loss', 'mean_squared_error', 'precision', 'r2', 'recall', 'roc_auc']
-    score = cross_val_score(clf, data, target, cv=cv, scoring='accuracy')
-    logging.info(score)
-    logging.info("Average score = %f", np.mean(score, dtype=np.float64))
+    return data, target
+
+
+EXPERIMENTS_DATA = []
+
+
+def set_experiments_data(experiments_data):
+    del EXPERIMENTS_DATA[:]
+    EXPERIMENTS_DATA.extend(experiments_data)
+
+
+def get_classifier(seed=None):
+    return RandomForestClassifier(n_estimators=20, random_state=seed)
+
+
+def fold_seed(base_seed, experiment_index, fold_index):
+    # Every fold's forest gets its own seed, the same whichever worker scores it
+    return np.random.RandomState([base_seed, experiment_index, fold_index]).randint(2 ** 31)
+
+
+def score_fold(task):
+    experiment_index, fold_index, train, test, seed = task
+    data, target = EXPERIMENTS_DATA[experiment_index]
+    start = time.time()
+    clf = get_classifier(seed)
+    clf.fit(data[train], target[train])
+    # Same as the 'accuracy' scoring of cross_val_score
+    score = clf.score(data[test], target[test])
+    return experiment_index, fold_index, score, time.time() - start
+
+
+def hash_array(h, a):
+    a = np.ascontiguousarray(a)
+    h.update(str(a.dtype) + str(a.shape))
+    h.update(a.view(np.uint8))
+
+
+def hash_experiment_data(data, target):
+    h = hashlib.sha1()
+    if scipy.sparse.issparse(data):
+        h.update("csr" + str(data.shape))
+        for a in [data.data, data.indices, data.indptr]:
+            hash_array(h, a)
+    else:
+        hash_array(h, data)
+    hash_array(h, target)
+    return h.hexdigest()
+
+
+def fold_cache_key(experiment_hash, train, test, seed):
+    h = hashlib.sha1(experiment_hash)
+    hash_array(h, train)
+    hash_array(h, test)
+    h.update(repr(sorted(get_classifier(seed).get_params().items())))
+    h.update(repr(seed))
+    return h.hexdigest()
+
+
+class FoldCache(object):
+    # Fold scores on disk, one small file per fold, least recently used evicted above max_size bytes
+    def __init__(self, location, max_size):
+        self.location = location
+        self.max_size = max_size
+        if not os.path.isdir(location):
+            os.makedirs(location)
+
+    def filename(self, key):
+        return os.path.join(self.location, key + ".json")
+
+    def get(self, key):
+        filename = self.filename(key)
+        if not os.path.exists(filename):
+            return None
+        with open(filename) as f:
+            res = json.load(f)
+        os.utime(filename, None)
+        return res["score"], res["fold_time"]
+
+    def put(self, key, score, fold_time):
+        # Written aside and renamed so a crash never leaves a partial entry
+        filename = self.filename(key)
+        with open(filename + ".tmp", "w") as f:
+            json.dump({"score": score, "fold_time": fold_time}, f)
+        os.rename(filename + ".tmp", filename)
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.location):
+            if name.endswith(".json"):
+                st = os.stat(os.path.join(self.location, name))
+                entries.append((st.st_mtime, st.st_size, name))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            os.remove(os.path.join(self.location, name))
+            total_size -= size
+            logging.debug("Evicted fold cache entry %s", name)
+
+
+def score_experiments_cross_validated(experiments_data, workers=1, seed=None, cache=None):
+    if cache is not None and seed is None:
+        # Without a seed the forests differ between runs, so there is nothing to reuse
+        logging.info("No seed given, not using the fold cache")
+        cache = None
+    # Drawn once here, forked workers share the parent's global RNG state and would grow correlated forests
+    base_seed = seed if seed is not None else np.random.randint(2 ** 31)
+    scores = [np.zeros(FOLD_AMOUNT) for _ in experiments_data]
+    fold_times = [np.zeros(FOLD_AMOUNT) for _ in experiments_data]
+    # Every fold of every experiment is a separate task, so all of them share the workers
+    tasks = []
+    cache_keys = {}
+    for experiment_index, (data, target) in enumerate(experiments_data):
+        cv = StratifiedKFold(target, n_folds=FOLD_AMOUNT)
+        experiment_hash = hash_experiment_data(data, target) if cache is not None else None
+        for fold_index, (train, test) in enumerate(cv):
+            forest_seed = fold_seed(base_seed, experiment_index, fold_index)
+            if cache is not None:
+                key = fold_cache_key(experiment_hash, train, test, forest_seed)
+                cached = cache.get(key)
+                if cached is not None:
+                    scores[experiment_index][fold_index], fold_times[experiment_index][fold_index] = cached
+                    continue
+                cache_keys[experiment_index, fold_index] = key
+            tasks.append((experiment_index, fold_index, train, test, forest_seed))
+    logging.info("Scoring %d folds of %d experiments with %d workers (%d folds cached)", len(tasks),
+                 len(experiments_data), workers, len(experiments_data) * FOLD_AMOUNT - len(tasks))
+    if workers > 1 and len(tasks) > 1:
+        pool = Pool(workers, initializer=set_experiments_data, initargs=(experiments_data,))
+        try:
+            results = pool.map(score_fold, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        set_experiments_data(experiments_data)
+        results = [score_fold(task) for task in tasks]
+
+    for experiment_index, fold_index, score, fold_time in results:
+        scores[experiment_index][fold_index] = score
+        fold_times[experiment_index][fold_index] = fold_time
+        if cache is not None:
+            cache.put(cache_keys[experiment_index, fold_index], score, fold_time)
+    if cache is not None:
+        cache.evict()
+    return scores, fold_times
+
+
+def detect_native_lang(chunks_by_class, chunk_size, workers=1, seed=None, cache=None):
+    # chunks_by_class holds every class' chunks' counts, returns the fold scores of every experiment in order
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+
+    sample_size = min([len(c) if isinstance(c, list) else c.shape[0] for c in chunks_by_class.values()])
+    logging.info("Using sample amount of %d samples (min of all classes)", sample_size)
+
+    samples_by_class = {}
+    i = 0
+    for k in [EN_LINES_KEY, EN_NON_NATIVE_LINES_KEY, FR_LINES_KEY]:
+        # Per class - normalized frequency vector as input, labelling for class
+        samples_by_class[k] = (sample_chunks_frequencies(chunks_by_class[k], sample_size, chunk_size),
+                               np.repeat(i, sample_size))
+        i += 1
+
+    experiments_data = [get_experiment_data([samples_by_class[k][0] for k in keys], [samples_by_class[k][1] for k in keys])
+                        for keys in EXPERIMENTS]
+    scores, fold_times = score_experiments_cross_validated(experiments_data, workers, seed, cache)
+
+    for keys, score, times in zip(EXPERIMENTS, scores, fold_times):
+        logging.info("Scoring %s",str(keys))
+        logging.debug("Fold times in seconds: %s", str(times))
+        logging.info(score)
+        logging.info("Average score = %f", np.mean(score, dtype=np.float64))
+    return scores
 
 
 def parse_args():
@@ -34,6 +249,12 @@ def parse_args():
     p.add_argument("-d","--debug",action='store_true')
     p.add_argument("--input-location",default="/tmp/")
     p.add_argument("-c","--chunk-size",type=int,default=1000)
+    p.add_argument("--counts-format",choices=COUNTS_FORMATS,default=COUNTS_FORMAT_JSON)
+    p.add_argument("-w","--workers",type=int,default=1, help="Amount of processes scoring the folds")
+    p.add_argument("--seed",type=int, help="Seed of the chunk sampling and the random forests")
+    p.add_argument("--cache-location",default="/tmp/fold-cache/", help="Where fold scores of seeded runs are cached")
+    p.add_argument("--cache-size",type=int,default=10, help="Fold cache size limit in MB")
+    p.add_argument("--no-cache",action='store_true')
     return p.parse_args()
 
 
@@ -43,37 +264,7 @@ if __name__ == '__main__':
 
     chunks_by_class = {}
     for k in [EN_LINES_KEY, EN_NON_NATIVE_LINES_KEY, FR_LINES_KEY]:
-        filename = args.input_location + CHUNK_FILENAME_PREFIX.format(k, str(args.chunk_size)) + COUNTS_SUFFIX
-        logging.info("Loading chunks from %s", filename)
-        chunks_by_class[k] = json.load(open(filename))
-
-    sample_size = min([len(c) for c in chunks_by_class.values()])
-    logging.info("Using sample amount of %d samples (min of all classes)", sample_size)
-
-    i = 0
-    for k in [EN_LINES_KEY, EN_NON_NATIVE_LINES_KEY, FR_LINES_KEY]:
-        # Shuffle chunks used for better lexical diversity
-        shuffle(chunks_by_class[k])
-        # Use only sample_size chunks
-        chunks_by_class[k] = chunks_by_class[k][:sample_size]
-        # counts to frequencies
-        chunks_by_class[k] = map(lambda chunk: [count / float(args.chunk_size) for count in chunk], chunks_by_class[k])
-        # Per class - normalized frequency vector as input, labelling for class
-        chunks_by_class[k] = (np.asarray(chunks_by_class[k], np.float), np.repeat(i, sample_size))
-        i += 1
-
-    keys = [EN_LINES_KEY, FR_LINES_KEY]
-    logging.info("Scoring %s",str(keys))
-    score_cross_validated([chunks_by_class[k][0] for k in keys], [chunks_by_class[k][1] for k in keys])
-
-    keys = [FR_LINES_KEY, EN_NON_NATIVE_LINES_KEY]
-    logging.info("Scoring %s",str(keys))
-    score_cross_validated([chunks_by_class[k][0] for k in keys], [chunks_by_class[k][1] for k in keys])
-
-    keys = [EN_LINES_KEY, EN_NON_NATIVE_LINES_KEY]
-    logging.info("Scoring %s",str(keys))
-    score_cross_validated([chunks_by_class[k][0] for k in keys], [chunks_by_class[k][1] for k in keys])
+        chunks_by_class[k] = load_chunks_counts(args.input_location, k, args.chunk_size, args.counts_format)
 
-    keys = [EN_LINES_KEY, EN_NON_NATIVE_LINES_KEY, FR_LINES_KEY]
-    logging.info("Scoring %s",str(keys))
-    score_cross_validated([chunks_by_class[k][0] for k in keys], [chunks_by_class[k][1] for k in keys])
+    cache = None if args.no_cache else FoldCache(args.cache_location, args.cache_size * 1024 * 1024)
+    detect_native_lang(chunks_by_class, args.chunk_size, args.workers, args.seed, cache)
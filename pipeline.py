@@ -0,0 +1,300 @@
+#!/usr/bin/python
+
+import argparse
+import hashlib
+import subprocess
+import sys
+
+from shared import *
+import calc_chunk_counts
+import calc_corpus_metrics
+import corpus_to_files
+import native_lang_detection
+
+
+PIPELINE_STATE_FILENAME = "pipeline-state.json"
+SPEAKERS_FILENAME = "speakers-out.json"
+METRICS_LOG_FILENAME = "metrics-out.log"
+SCORES_LOG_FILENAME = "scores-out.log"
+HASH_BLOCK_SIZE = 1 << 20
+CLASS_KEYS = [EN_LINES_KEY, EN_NON_NATIVE_LINES_KEY, FR_LINES_KEY]
+
+
+def lines_inputs(args):
+    inputs = [args.output_location + lines_filename(args.lines_format)]
+    if args.lines_format == LINES_FORMAT_LINE_NUMBERS:
+        # The line numbers point into the corpus itself
+        inputs.append(args.file_pattern + EN_SUFFIX)
+    return inputs
+
+
+def counts_files(args):
+    return [chunks_counts_filename(args.output_location, k, args.chunk_size, args.counts_format) for k in CLASS_KEYS]
+
+
+def speakers_stage(args):
+    return {
+        "name": "speakers",
+        "command": ["corpus_to_files.py", "-p", args.file_pattern, "--output-location", args.output_location,
+                    "-w", str(args.workers), "--speakers-only"],
+        "code": ["corpus_to_files.py", "shared.py"],
+        "params": [],
+        "inputs": [args.file_pattern + ID_SUFFIX],
+        "outputs": [args.output_location + SPEAKERS_FILENAME]
+    }
+
+
+def lines_stage(args):
+    # Splits the saved speakers' lines to classes, a new threshold does not parse the .id file again
+    command = ["corpus_to_files.py", "-p", args.file_pattern, "--output-location", args.output_location,
+               "--speaker-stats-from-file", "-t", str(args.threshold), "--lines-format", args.lines_format]
+    if args.show_graph:
+        command.append("--show-graph")
+    return {
+        "name": "lines",
+        "command": command,
+        "code": ["corpus_to_files.py", "shared.py"],
+        "params": [args.file_pattern, args.threshold, args.lines_format],
+        "inputs": [args.output_location + SPEAKERS_FILENAME, args.file_pattern + EN_SUFFIX],
+        "outputs": [args.output_location + lines_filename(args.lines_format)]
+    }
+
+
+def metrics_stage(args):
+    command = ["calc_corpus_metrics.py", "-j", args.output_location, "--lines-format", args.lines_format,
+               "--bootstrap", str(args.bootstrap), "-w", str(args.workers)]
+    if args.seed is not None:
+        command.extend(["--seed", str(args.seed)])
+    if args.show_graph:
+        command.append("--show-graph")
+    return {
+        "name": "metrics",
+        "command": command,
+        "code": ["calc_corpus_metrics.py", "shared.py", "en_idioms.py", "en_cohesive_markers.py", "en_pronouns.py"],
+        "params": [args.lines_format, args.bootstrap, args.seed],
+        "inputs": lines_inputs(args),
+        "log": args.output_location + METRICS_LOG_FILENAME
+    }
+
+
+def chunks_stage(args):
+    return {
+        "name": "chunks",
+        "command": ["calc_chunk_counts.py", "-j", args.output_location, "--output-location", args.output_location,
+                    "--lines-format", args.lines_format, "--pos-counts", "--function-word-counts",
+                    "-c", str(args.chunk_size), "--counts-format", args.counts_format, "--jobs", str(args.workers)],
+        "code": ["calc_chunk_counts.py", "shared.py", "en_function_words.py"],
+        "params": [args.lines_format, args.chunk_size, args.counts_format],
+        "inputs": lines_inputs(args),
+        "outputs": counts_files(args)
+    }
+
+
+def detection_stage(args):
+    command = ["native_lang_detection.py", "--input-location", args.output_location, "-c", str(args.chunk_size),
+               "--counts-format", args.counts_format, "-w", str(args.workers)]
+    if args.seed is not None:
+        command.extend(["--seed", str(args.seed)])
+    return {
+        "name": "detection",
+        "command": command,
+        "code": ["native_lang_detection.py", "shared.py"],
+        "params": [args.chunk_size, args.counts_format, args.seed],
+        "inputs": counts_files(args),
+        "log": args.output_location + SCORES_LOG_FILENAME
+    }
+
+
+STAGES = [speakers_stage, lines_stage, metrics_stage, chunks_stage, detection_stage]
+
+
+def load_pipeline_state(output_location):
+    file = output_location + PIPELINE_STATE_FILENAME
+    if not os.path.exists(file):
+        return {"stages": {}, "file_hashes": {}}
+    return json.load(open(file))
+
+
+def output_pipeline_state(output_location, state):
+    output = output_location + PIPELINE_STATE_FILENAME
+    with open(output + ".tmp", 'w') as out:
+        json.dump(state, out, sort_keys=True, indent=4, separators=(',', ': '))
+    os.rename(output + ".tmp", output)
+
+
+def hash_file(filename, file_hashes):
+    # Content hashes are reused while the file's size and modification time stay the same
+    st = os.stat(filename)
+    cached = file_hashes.get(filename)
+    if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime:
+        return cached[2]
+    logging.debug("Hashing %s", filename)
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            h.update(block)
+    file_hashes[filename] = [st.st_size, st.st_mtime, h.hexdigest()]
+    return h.hexdigest()
+
+
+def stage_fingerprint(stage, file_hashes):
+    # The stage's code with the word lists it imports, parameters and input contents, like make but by content
+    h = hashlib.sha1()
+    for filename in stage["code"]:
+        h.update(hash_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), filename), file_hashes))
+    h.update(repr(stage["params"]))
+    for filename in stage["inputs"]:
+        h.update(filename + hash_file(filename, file_hashes))
+    return h.hexdigest()
+
+
+def stage_outputs(stage):
+    return stage.get("outputs", []) + ([stage["log"]] if "log" in stage else [])
+
+
+def stage_state_key(stage):
+    # Outputs that differ by parameters, like the chunk size, are remembered side by side
+    return stage["name"] + ":" + ",".join(stage_outputs(stage))
+
+
+def run_stage(stage):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), stage["command"][0])] + \
+              stage["command"][1:]
+    logging.info("Running stage %s: %s", stage["name"], " ".join(command))
+    if "log" not in stage:
+        return subprocess.call(command)
+    # Stages whose results are only logged keep their log as their output
+    proc = subprocess.Popen(command, stderr=subprocess.PIPE)
+    with open(stage["log"] + ".tmp", 'w') as log:
+        for line in iter(proc.stderr.readline, b""):
+            sys.stderr.write(line)
+            log.write(line)
+    res = proc.wait()
+    if res == 0:
+        os.rename(stage["log"] + ".tmp", stage["log"])
+    return res
+
+
+def run_pipeline(args):
+    state = load_pipeline_state(args.output_location)
+    for stage in [s(args) for s in STAGES]:
+        missing = [f for f in stage["inputs"] if not os.path.exists(f)]
+        if missing:
+            logging.error("Stage %s is missing its inputs %s", stage["name"], ", ".join(missing))
+            return 1
+        fingerprint = stage_fingerprint(stage, state["file_hashes"])
+        key = stage_state_key(stage)
+        outputs_exist = all(os.path.exists(f) for f in stage_outputs(stage))
+        if not args.force and outputs_exist and state["stages"].get(key) == fingerprint:
+            logging.info("Skipping stage %s, its inputs and parameters are unchanged", stage["name"])
+            if "log" in stage:
+                with open(stage["log"]) as log:
+                    sys.stderr.write(log.read())
+            continue
+        res = run_stage(stage)
+        if res != 0:
+            logging.error("Stage %s failed with exit code %d", stage["name"], res)
+            # A failed stage is not recorded, so it runs again next time
+            state["stages"].pop(key, None)
+            output_pipeline_state(args.output_location, state)
+            return res
+        state["stages"][key] = fingerprint
+        output_pipeline_state(args.output_location, state)
+    return 0
+
+
+def run(file_pattern, threshold=0.5, chunk_size=1000, seed=None, bootstrap=0, workers=1, output_location=None,
+        counts_format=COUNTS_FORMAT_NPY, show_graph=False):
+    # All stages in this process, handing the data over in memory, intermediates written only with output_location
+    speakers = corpus_to_files.get_speakers_stats_from_id_file(file_pattern, workers)
+    if output_location is not None:
+        corpus_to_files.output_speakers_json(output_location, speakers)
+    if show_graph:
+        corpus_to_files.create_minimum_lines_speakers_graph(speakers)
+
+    line_nums_by_class = corpus_to_files.split_lines_by_class(speakers, threshold)
+    en_filename = file_pattern + EN_SUFFIX
+    # Decoded to unicode, as the later stages load the lines from any format
+    class_lines = corpus_to_files.select_class_lines(LineStore(en_filename, output_location), line_nums_by_class,
+                                                     decode=True)
+    vocab, encoded = encode_lines_dict(class_lines)
+    if output_location is not None:
+        output_lines_line_numbers(output_location, en_filename, line_nums_by_class)
+        output_encoded_corpus(output_location, vocab, encoded, [output_location + LINES_LINE_NUMBERS_FILENAME])
+
+    if bootstrap > 0:
+        token_count = min([len(e.tokens) for e in encoded.values()])
+        logging.info("Token amount for metric calculations = %d", token_count)
+        metrics = calc_corpus_metrics.calc_metrics_bootstrap(vocab, encoded, token_count, bootstrap, workers, seed)
+    else:
+        metrics, metric_keys = calc_corpus_metrics.calc_metrics(class_lines, seed)
+        if show_graph:
+            calc_corpus_metrics.plot_metrics(metrics, metric_keys)
+
+    counters = calc_chunk_counts.get_chunks_counters(vocab, encoded)
+    counts_by_class = calc_chunk_counts.count_chunks(encoded, chunk_size, counters, workers)
+    if output_location is not None:
+        for key, counts in counts_by_class.items():
+            calc_chunk_counts.output_chunks_counts(output_location, key, chunk_size, counts_format, [counts],
+                                                   len(counts))
+
+    scores = native_lang_detection.detect_native_lang(counts_by_class, chunk_size, workers, seed)
+    return {
+        "speakers": speakers,
+        "lines": class_lines,
+        "vocab": vocab,
+        "encoded": encoded,
+        "metrics": metrics,
+        "counts": counts_by_class,
+        "scores": dict(zip([tuple(keys) for keys in native_lang_detection.EXPERIMENTS], scores))
+    }
+
+
+def confirm_interactive():
+    while True:
+        yn = raw_input("Please make sure to close figure windows after looking/saving to allow continuation of the "
+                       "analysis, OK? [Yy/Nn] \n")
+        if yn[:1] in ["Y", "y"]:
+            return True
+        if yn[:1] in ["N", "n"]:
+            return False
+        print "Please answer yes [Y/y] or no [N/n]."
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("-d","--debug",action='store_true')
+    p.add_argument("-p","--file-pattern", required=True, help="The base file name pattern where the files with suffixes {%s,%s,%s} are"%(ID_SUFFIX, EN_SUFFIX, FR_SUFFIX))
+    p.add_argument("--output-location",default="/tmp/")
+    p.add_argument("-t","--threshold",type=float,default=0.5, choices=[x/10.0 for x in xrange(0, 10, 1)])
+    p.add_argument("--lines-format",choices=LINES_FORMATS,default=LINES_FORMAT_JSON)
+    p.add_argument("-c","--chunk-size",type=int,default=1000)
+    p.add_argument("--counts-format",choices=COUNTS_FORMATS,default=COUNTS_FORMAT_JSON)
+    p.add_argument("--bootstrap",type=int,default=0, help="Amount of resamples per class for the metrics' confidence intervals")
+    p.add_argument("--seed",type=int, help="Seed of the metrics sampling and the classifiers")
+    p.add_argument("-w","--workers",type=int,default=1, help="Amount of processes each stage may use")
+    p.add_argument("--non-interactive",action='store_true', help="No prompt and no figure windows, for batch servers")
+    p.add_argument("--force",action='store_true', help="Run all stages even if their inputs are unchanged")
+    p.add_argument("--in-process",action='store_true', help="Run all stages in this process, passing the data in memory")
+    p.add_argument("--no-intermediates",action='store_true', help="With --in-process, do not write the stages' outputs")
+    args = p.parse_args()
+    args.show_graph = not args.non_interactive
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    set_logging(args.debug)
+
+    logging.info("Running Native, Non-Native, Translated NLP analysis on file pattern %s", args.file_pattern)
+    if args.non_interactive:
+        # Figures are drawn off screen so nothing waits for a window to be closed
+        os.environ["MPLBACKEND"] = "Agg"
+    elif not confirm_interactive():
+        sys.exit(0)
+
+    if args.in_process:
+        run(args.file_pattern, args.threshold, args.chunk_size, args.seed, args.bootstrap, args.workers,
+            None if args.no_intermediates else args.output_location, args.counts_format, args.show_graph)
+    else:
+        sys.exit(run_pipeline(args))
@@ -1,5 +1,12 @@
+import hashlib
 import logging
 import json
+from array import array
+import mmap
+import os
+import resource
+import struct
+import numpy as np
 
 
 ID_SUFFIX = ".id"
@@ -12,6 +19,30 @@ EN_PERCENT_KEY = "EN_PERCENT"
 FR_PERCENT_KEY = "FR_PERCENT"
 CHUNK_FILENAME_PREFIX = "{}-chunk-size-{}"
 COUNTS_SUFFIX = '-counts.json'
+COUNTS_NPZ_SUFFIX = '-counts.npz'
+COUNTS_NPY_SUFFIX = '-counts.npy'
+COUNTS_FORMAT_JSON = "json"
+COUNTS_FORMAT_NPZ = "npz"
+COUNTS_FORMAT_NPY = "npy"
+COUNTS_FORMATS = [COUNTS_FORMAT_JSON, COUNTS_FORMAT_NPZ, COUNTS_FORMAT_NPY]
+LINE_INDEX_SUFFIX = ".line-index.npy"
+LINES_JSON_FILENAME = "lines-out.json"
+LINES_BINARY_FILENAME = "lines-out.bin"
+LINES_LINE_NUMBERS_FILENAME = "lines-out-line-numbers.npz"
+LINES_FORMAT_JSON = "json"
+LINES_FORMAT_BINARY = "binary"
+LINES_FORMAT_LINE_NUMBERS = "line-numbers"
+LINES_FORMATS = [LINES_FORMAT_JSON, LINES_FORMAT_BINARY, LINES_FORMAT_LINE_NUMBERS]
+LINES_CORPUS_KEY = "CORPUS"
+VOCAB_FILENAME = "vocab-out.json"
+TOKENS_SUFFIX = "-tokens.npy"
+LINE_STARTS_SUFFIX = "-line-starts.npy"
+# magic, version, class amount, then per class: key length, key, section offset, line amount
+LINES_BINARY_MAGIC = b"NLPLINES"
+LINES_BINARY_VERSION = 1
+LINES_BINARY_HEADER = struct.Struct("<8sII")
+LINES_BINARY_CLASS_HEADER = struct.Struct("<H")
+LINES_BINARY_CLASS_SECTION = struct.Struct("<QQ")
 
 
 def set_logging(debug):
@@ -22,8 +53,13 @@ def set_logging(debug):
         logging.getLogger().setLevel(logging.INFO)
 
 
+def log_peak_rss(stage):
+    # ru_maxrss is in kilobytes on Linux
+    logging.info("Peak RSS %s = %.1f MB", stage, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+
+
 def load_lines_json(output_location):
-    file = output_location + "lines-out.json"
+    file = output_location + LINES_JSON_FILENAME
     logging.info("Loading lines from " + file)
     lines = {}
     with open(file) as f:
@@ -31,12 +67,371 @@ def load_lines_json(output_location):
     return lines
 
 
+def encode_line(line):
+    return line.encode("utf-8") if not isinstance(line, bytes) else line
+
+
+def decode_line(line):
+    # Lines are unicode in every format, as json.load returns them
+    return line.decode("utf-8") if isinstance(line, bytes) else line
+
+
+def output_lines_binary(output_location, lines):
+    # Each class section holds uint32 line lengths followed by the concatenated UTF-8 lines
+    output = output_location + LINES_BINARY_FILENAME
+    logging.info("Outputting lines to %s", output)
+    class_keys = sorted(lines.keys())
+    header_size = LINES_BINARY_HEADER.size + sum(LINES_BINARY_CLASS_HEADER.size + len(k) +
+                                                 LINES_BINARY_CLASS_SECTION.size for k in class_keys)
+    sections = []
+    section_offset = header_size
+    for class_key in class_keys:
+        encoded_lines = [encode_line(l) for l in lines[class_key]]
+        lengths = np.array([len(l) for l in encoded_lines], dtype="<u4")
+        sections.append((class_key, section_offset, lengths, encoded_lines))
+        section_offset += lengths.nbytes + int(lengths.sum(dtype=np.int64))
+    with open(output, 'wb') as out:
+        out.write(LINES_BINARY_HEADER.pack(LINES_BINARY_MAGIC, LINES_BINARY_VERSION, len(class_keys)))
+        for class_key, offset, lengths, _ in sections:
+            key = encode_line(class_key)
+            out.write(LINES_BINARY_CLASS_HEADER.pack(len(key)))
+            out.write(key)
+            out.write(LINES_BINARY_CLASS_SECTION.pack(offset, len(lengths)))
+        for _, _, lengths, encoded_lines in sections:
+            out.write(lengths.tostring())
+            for l in encoded_lines:
+                out.write(l)
+
+
+class PackedLines(object):
+    # Read-only sequence of UTF-8 lines packed back to back in a buffer, served as unicode
+
+    def __init__(self, buf, starts, ends):
+        self.buf = buf
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return PackedLines(self.buf, self.starts[i], self.ends[i])
+        return decode_line(self.buf[int(self.starts[i]):int(self.ends[i])])
+
+    def __iter__(self):
+        buf = self.buf
+        for start, end in zip(self.starts.tolist(), self.ends.tolist()):
+            yield decode_line(buf[start:end])
+
+
+def load_lines_binary(output_location):
+    file = output_location + LINES_BINARY_FILENAME
+    logging.info("Loading lines from " + file)
+    with open(file, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, class_amount = LINES_BINARY_HEADER.unpack_from(mm, 0)
+    assert magic == LINES_BINARY_MAGIC and version == LINES_BINARY_VERSION, file + " is not a lines binary file"
+    position = LINES_BINARY_HEADER.size
+    lines = {}
+    for _ in range(class_amount):
+        key_length, = LINES_BINARY_CLASS_HEADER.unpack_from(mm, position)
+        position += LINES_BINARY_CLASS_HEADER.size
+        class_key = mm[position:position + key_length].decode("ascii")
+        position += key_length
+        section_offset, line_amount = LINES_BINARY_CLASS_SECTION.unpack_from(mm, position)
+        position += LINES_BINARY_CLASS_SECTION.size
+        lengths = np.frombuffer(mm, dtype="<u4", count=line_amount, offset=section_offset)
+        ends = np.cumsum(lengths, dtype=np.int64) + section_offset + lengths.nbytes
+        lines[str(class_key)] = PackedLines(mm, ends - lengths, ends)
+    return lines
+
+
+def output_lines_line_numbers(output_location, corpus_filename, line_nums_by_class):
+    # Only the 1-based line numbers of each class, the text stays in the corpus file
+    output = output_location + LINES_LINE_NUMBERS_FILENAME
+    logging.info("Outputting line numbers to %s", output)
+    arrays = {k: np.asarray(nums, dtype=np.uint32) for k, nums in line_nums_by_class.items()}
+    arrays[LINES_CORPUS_KEY] = np.array(os.path.abspath(corpus_filename))
+    with open(output, 'wb') as out:
+        np.savez(out, **arrays)
+
+
+def load_lines_line_numbers(output_location):
+    file = output_location + LINES_LINE_NUMBERS_FILENAME
+    logging.info("Loading line numbers from " + file)
+    with np.load(file) as arrays:
+        corpus_filename = str(arrays[LINES_CORPUS_KEY])
+        line_nums_by_class = {str(k): arrays[k] for k in arrays.files if k != LINES_CORPUS_KEY}
+    store = LineStore(corpus_filename, output_location)
+    return {k: store.select(nums.astype(np.int64) - 1, decode=True) for k, nums in line_nums_by_class.items()}
+
+
+def load_lines(output_location, lines_format=LINES_FORMAT_JSON):
+    if lines_format == LINES_FORMAT_BINARY:
+        return load_lines_binary(output_location)
+    if lines_format == LINES_FORMAT_LINE_NUMBERS:
+        return load_lines_line_numbers(output_location)
+    return load_lines_json(output_location)
+
+
 def lines_dict_to_words_dict(lines):
     logging.info("Generating list of words from corpus")
     words = {}
     for class_key in lines.keys():
         words[class_key] = []
         for l in lines[class_key]:
-            split_line = l.split()
-            words[class_key].extend(split_line)
+            words[class_key].extend(l.split())
     return words
+
+
+def lines_dict_to_words_and_line_starts(lines):
+    # The words of every class with the offsets where its lines start, line i is words[starts[i]:starts[i + 1]]
+    logging.info("Generating list of words and line offsets from corpus")
+    words = {}
+    line_starts = {}
+    for class_key in lines.keys():
+        class_words = []
+        starts = [0]
+        for l in lines[class_key]:
+            class_words.extend(l.split())
+            starts.append(len(class_words))
+        words[class_key] = class_words
+        line_starts[class_key] = np.array(starts, dtype=np.int64)
+    return words, line_starts
+
+
+def build_line_index(filename, block_size=64 * 1024 * 1024):
+    # offsets[i] is where line i starts, the last entry is the file size
+    # Lines end at \n, \r\n or a bare \r, as read().splitlines() splits them
+    logging.info("Building line index for %s", filename)
+    offsets = [np.zeros(1, dtype=np.int64)]
+    position = 0
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            # A \r ending the block needs the next byte to tell a bare \r from \r\n
+            while block.endswith(b"\r"):
+                next_byte = f.read(1)
+                if not next_byte:
+                    break
+                block += next_byte
+            data = np.frombuffer(block, dtype=np.uint8)
+            line_breaks = data == ord("\n")
+            bare_returns = data == ord("\r")
+            bare_returns[:-1] &= data[1:] != ord("\n")
+            newlines = np.flatnonzero(line_breaks | bare_returns)
+            offsets.append(newlines.astype(np.int64) + position + 1)
+            position += len(block)
+    offsets = np.concatenate(offsets)
+    if offsets[-1] != position:
+        # Last line has no trailing newline
+        offsets = np.append(offsets, position)
+    logging.info("Done building line index for %s, %d lines", filename, len(offsets) - 1)
+    return offsets
+
+
+def line_index_filename(filename, index_location):
+    # Keyed on the absolute path, corpora sharing a basename in different directories get their own index
+    path_hash = hashlib.md5(os.path.abspath(filename)).hexdigest()[:12]
+    return index_location + os.path.basename(filename) + "." + path_hash + LINE_INDEX_SUFFIX
+
+
+def load_line_index(filename, index_location):
+    if index_location is None:
+        return build_line_index(filename)
+    index_file = line_index_filename(filename, index_location)
+    if os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(filename):
+        offsets = np.load(index_file)
+        if len(offsets) > 0 and offsets[-1] == os.path.getsize(filename):
+            logging.info("Loaded line index for %s from %s", filename, index_file)
+            return offsets
+    offsets = build_line_index(filename)
+    logging.info("Saving line index to %s", index_file)
+    np.save(index_file, offsets)
+    return offsets
+
+
+class LineStore(object):
+    # Lines of a corpus file served lazily from an mmap and its line-offset index
+
+    def __init__(self, filename, index_location):
+        self.filename = filename
+        self.offsets = load_line_index(filename, index_location)
+        with open(filename, 'rb') as f:
+            if self.offsets[-1] > 0:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._mm = b""
+        # Zero-copy byte view over the whole file
+        self.data = np.frombuffer(self._mm, dtype=np.uint8) if len(self._mm) > 0 else np.zeros(0, np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def line_span(self, i):
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        while end > start and self._mm[end - 1:end] in (b"\n", b"\r"):
+            end -= 1
+        return start, end
+
+    def __getitem__(self, i):
+        start, end = self.line_span(i)
+        return self._mm[start:end]
+
+    def line_view(self, i):
+        start, end = self.line_span(i)
+        return self.data[start:end]
+
+    def tokens(self, i):
+        return self[i].split()
+
+    def select(self, line_nums, decode=False):
+        return LineSelection(self, line_nums, decode)
+
+
+class LineSelection(object):
+    # Read-only sequence of some of a LineStore's lines, resolved only when accessed
+
+    def __init__(self, store, line_nums, decode=False):
+        self.store = store
+        # 0-based line numbers into the store
+        self.line_nums = np.asarray(line_nums, dtype=np.int64)
+        # Lines are served as unicode instead of the corpus's UTF-8 bytes
+        self.decode = decode
+
+    def __len__(self):
+        return len(self.line_nums)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return LineSelection(self.store, self.line_nums[i], self.decode)
+        line = self.store[self.line_nums[i]]
+        return decode_line(line) if self.decode else line
+
+    def __iter__(self):
+        for i in self.line_nums:
+            line = self.store[i]
+            yield decode_line(line) if self.decode else line
+
+    def iter_tokens(self):
+        for line in self:
+            for token in line.split():
+                yield token
+
+
+class EncodedLines(object):
+    # A class's tokens as vocabulary IDs, line i is tokens[line_starts[i]:line_starts[i + 1]]
+
+    def __init__(self, tokens, line_starts):
+        self.tokens = tokens
+        self.line_starts = line_starts
+
+    def __len__(self):
+        return len(self.line_starts) - 1
+
+    def line(self, i):
+        return self.tokens[self.line_starts[i]:self.line_starts[i + 1]]
+
+    def line_lengths(self):
+        return np.diff(self.line_starts)
+
+
+def encode_lines_dict(lines, vocab=None):
+    logging.info("Encoding corpus words as vocabulary IDs")
+    vocab = list(vocab) if vocab is not None else []
+    word_ids = {w: i for i, w in enumerate(vocab)}
+    encoded = {}
+    for class_key in sorted(lines.keys()):
+        tokens = array('i')
+        line_starts = array('l', [0])
+        for l in lines[class_key]:
+            for w in l.split():
+                word_id = word_ids.get(w)
+                if word_id is None:
+                    word_id = word_ids[w] = len(vocab)
+                    vocab.append(w)
+                tokens.append(word_id)
+            line_starts.append(len(tokens))
+        encoded[class_key] = EncodedLines(np.frombuffer(tokens, dtype=np.int32).copy(),
+                                          np.frombuffer(line_starts, dtype=np.dtype('l')).astype(np.int64))
+        logging.info("Encoded %d tokens of %s", len(tokens), class_key)
+    logging.info("Vocabulary size = %d", len(vocab))
+    return vocab, encoded
+
+
+def lines_file_stats(filename):
+    return {"name": os.path.basename(filename), "size": os.path.getsize(filename), "mtime": os.path.getmtime(filename)}
+
+
+# lines_files are the lines files the encoding was made from, written before it
+def output_encoded_corpus(output_location, vocab, encoded, lines_files=()):
+    for class_key, encoded_lines in encoded.items():
+        output = output_location + class_key + TOKENS_SUFFIX
+        logging.info("Outputting %s token IDs to %s", class_key, output)
+        np.save(output, encoded_lines.tokens)
+        np.save(output_location + class_key + LINE_STARTS_SUFFIX, encoded_lines.line_starts)
+    # The vocabulary goes last, a partly written encoding is never taken for a complete one
+    output = output_location + VOCAB_FILENAME
+    logging.info("Outputting vocabulary to %s", output)
+    with open(output, 'w') as out:
+        json.dump({"vocab": vocab, "lines_files": [lines_file_stats(f) for f in lines_files]}, out)
+
+
+def load_vocab(output_location):
+    file = output_location + VOCAB_FILENAME
+    logging.info("Loading vocabulary from %s", file)
+    with open(file) as f:
+        vocab = json.load(f)
+    if isinstance(vocab, list):
+        # Written before the lines files were recorded
+        return vocab, []
+    return vocab["vocab"], vocab["lines_files"]
+
+
+def load_encoded_corpus(output_location, class_keys, vocab=None):
+    if vocab is None:
+        vocab, _ = load_vocab(output_location)
+    encoded = {}
+    for class_key in class_keys:
+        logging.info("Loading %s token IDs from %s", class_key, output_location + class_key + TOKENS_SUFFIX)
+        encoded[class_key] = EncodedLines(np.load(output_location + class_key + TOKENS_SUFFIX, mmap_mode='r'),
+                                          np.load(output_location + class_key + LINE_STARTS_SUFFIX))
+    return vocab, encoded
+
+
+def lines_filename(lines_format):
+    return {
+        LINES_FORMAT_JSON: LINES_JSON_FILENAME,
+        LINES_FORMAT_BINARY: LINES_BINARY_FILENAME,
+        LINES_FORMAT_LINE_NUMBERS: LINES_LINE_NUMBERS_FILENAME
+    }[lines_format]
+
+
+def chunks_counts_filename(location, key, chunk_size, counts_format):
+    suffix = {
+        COUNTS_FORMAT_JSON: COUNTS_SUFFIX,
+        COUNTS_FORMAT_NPZ: COUNTS_NPZ_SUFFIX,
+        COUNTS_FORMAT_NPY: COUNTS_NPY_SUFFIX
+    }[counts_format]
+    return location + CHUNK_FILENAME_PREFIX.format(key, str(chunk_size)) + suffix
+
+
+def get_encoded_corpus(output_location, lines_format=LINES_FORMAT_JSON, lines=None):
+    # Reuse the persisted encoding only if it was made from this very lines file
+    class_keys = [EN_LINES_KEY, EN_NON_NATIVE_LINES_KEY, FR_LINES_KEY]
+    encoded_files = [output_location + VOCAB_FILENAME] + \
+                    [output_location + k + s for k in class_keys for s in [TOKENS_SUFFIX, LINE_STARTS_SUFFIX]]
+    lines_file = output_location + lines_filename(lines_format)
+    if all(os.path.exists(f) for f in encoded_files):
+        vocab, lines_files = load_vocab(output_location)
+        if lines_file_stats(lines_file) in lines_files:
+            return load_encoded_corpus(output_location, class_keys, vocab)
+        logging.info("Encoded corpus in %s was not made from %s, encoding again", output_location, lines_file)
+    if lines is None:
+        lines = load_lines(output_location, lines_format)
+    vocab, encoded = encode_lines_dict(lines)
+    output_encoded_corpus(output_location, vocab, encoded, [lines_file])
+    return vocab, encoded